@@ -0,0 +1,707 @@
+# Open Data Repository Data Publisher
+# Benchmarks for the ODR JupyterHub services
+# (C) 2015 by Nathan Stone (nate.stone@opendatarepository.org)
+# (C) 2015 by Alex Pires (ajpires@email.arizona.edu)
+# Released under the GPLv2
+
+"""
+Measures how odr_env, odr_oauth_manager and odr_bridge behave under load, without needing a real ODR server or a
+running JupyterHub.
+
+A stub of ODR's API and OAuth token endpoint is started on localhost, along with real instances of the OAuth manager
+and the bridge.  The stub expires access tokens after a configurable number of seconds and only accepts each refresh
+token once, the same way ODR does, so the token refresh paths get exercised as well.
+
+Usage:
+    python benchmarks/bench_odr_services.py [--users 1,10,100] [--concurrency 1,8,32] [--scenarios all] [--json out.json]
+
+Every scenario prints one line per combination of users/concurrency, with the number of operations, wall-clock time,
+throughput, and latency percentiles.  Each simulated user runs odr_env in its own process, the same as every user's
+notebook runs in its own kernel.  In the listing, record_fetch and file_download scenarios, concurrency is the number
+of simultaneous requests made by each user...otherwise it's the total for all users.  The final metrics reported by the manager and the bridge are printed at the end.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import getpass
+import grp
+import io
+import json
+import multiprocessing
+import os
+import secrets
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import nbformat as nbf
+import requests
+
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
+from tornado.web import Application, RequestHandler
+
+# The services live in the parent directory
+sys.path.insert(0, os.path.dirname( os.path.dirname( os.path.abspath(__file__) ) ))
+
+SCENARIOS = ('token_lookup', 'token_refresh', 'listing', 'record_fetch', 'file_download', 'notebook_creation')
+
+EXPIRED_MESSAGE = 'The access token provided has expired.'
+
+
+class StubState(object):
+    """
+    The state of the stub ODR server...which tokens are valid, and how many requests of each kind it has answered.
+    """
+
+    def __init__(self, num_records, file_size, token_lifetime, latency):
+        self.num_records = num_records
+        self.file_size = file_size
+        self.token_lifetime = token_lifetime
+        self.latency = latency
+
+        self.file_chunk = os.urandom(65536)
+        self.access_tokens = {}
+        self.refresh_tokens = set()
+        self.counts = {}
+        self.lock = threading.Lock()
+
+
+    def issue_tokens(self):
+        """
+        Returns a dict with a new access/refresh_token pair.
+        """
+
+        access_token = secrets.token_hex(20)
+        refresh_token = secrets.token_hex(20)
+        with self.lock:
+            self.access_tokens[access_token] = time.time() + self.token_lifetime
+            self.refresh_tokens.add(refresh_token)
+
+        return {'access_token': access_token, 'refresh_token': refresh_token, 'expires_in': self.token_lifetime, 'token_type': 'bearer'}
+
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+
+class StubHandler(RequestHandler):
+
+    def initialize(self, state):
+        self.state = state
+
+    async def prepare(self):
+        # Simulate the round trip to a remote ODR server
+        if self.state.latency > 0:
+            await asyncio.sleep(self.state.latency)
+
+    def check_access_token(self):
+        """
+        Writes ODR's error response and returns False if the request's access token isn't valid.
+        """
+
+        expires_at = self.state.access_tokens.get( self.get_argument('access_token', '') )
+        if expires_at is None:
+            self.set_status(401)
+            self.write({'error': 'invalid_grant', 'error_description': 'The access token provided is invalid.'})
+            return False
+        if expires_at < time.time():
+            self.state.count('expired_token_responses')
+            self.set_status(401)
+            self.write({'error': 'invalid_grant', 'error_description': EXPIRED_MESSAGE})
+            return False
+
+        return True
+
+
+class StubTokenHandler(StubHandler):
+    """
+    Stands in for ODR's /oauth/v2/token endpoint.  Refresh tokens can only be used once.
+    """
+
+    def get(self):
+        self.state.count('refresh_grants')
+
+        refresh_token = self.get_argument('refresh_token', '')
+        with self.state.lock:
+            valid = refresh_token in self.state.refresh_tokens
+            self.state.refresh_tokens.discard(refresh_token)
+
+        if self.get_argument('grant_type', '') != 'refresh_token' or not valid:
+            self.state.count('rejected_refresh_grants')
+            self.set_status(400)
+            self.write({'error': 'invalid_grant', 'error_description': 'Invalid refresh token'})
+            return
+
+        self.write( self.state.issue_tokens() )
+
+
+class StubRecordListHandler(StubHandler):
+    """
+    Stands in for ODR's /api/v1/databases/<id>/records.json endpoint.
+    """
+
+    def get(self, datatype_id):
+        if not self.check_access_token():
+            return
+        self.state.count('record_list')
+
+        offset = int( self.get_argument('offset', 0) )
+        limit = int( self.get_argument('limit', 999999999) )
+        if offset > self.state.num_records:
+            self.set_status(400)
+            self.write({'error': 'bad request', 'error_description': 'offset past end of records'})
+            return
+
+        records = []
+        for dr_id in range(offset + 1, min(offset + limit, self.state.num_records) + 1):
+            records.append({'internal_id': dr_id, 'unique_id': '%07x' % dr_id, 'external_id': str(dr_id), 'record_name': 'Sample ' + str(dr_id)})
+
+        self.write({'records': records})
+
+
+class StubRecordHandler(StubHandler):
+    """
+    Stands in for ODR's /api/v1/records/<id>.json endpoint, with a couple of datafields and child datarecords.
+    """
+
+    def get(self, datarecord_id):
+        if not self.check_access_token():
+            return
+        self.state.count('record')
+
+        dr_id = int(datarecord_id)
+        children = []
+        for i in range(3):
+            child_id = dr_id * 10 + i
+            children.append({
+                'internal_id': child_id,
+                'record_name': 'Spectrum ' + str(child_id),
+                'fields': {
+                    'field_3': {'field_name': 'Wavelength', 'id': 3, 'value': str(500 + i)},
+                    'field_4': {'field_name': 'Data', 'id': 4, 'files': [{'id': child_id, 'original_name': 'spectrum_' + str(child_id) + '.txt'}]},
+                },
+            })
+
+        self.write({'records': [{
+            'database_name': 'Sample',
+            'internal_id': dr_id,
+            'record_name': 'Sample ' + str(dr_id),
+            'fields': {
+                'field_1': {'field_name': 'Name', 'id': 1, 'value': 'Sample ' + str(dr_id)},
+                'field_2': {'field_name': 'Mass', 'id': 2, 'value': str(dr_id * 0.5)},
+            },
+            'child_records': {'Spectrum': {'records': children}},
+        }]})
+
+
+class StubFileHandler(StubHandler):
+    """
+    Stands in for ODR's /api/v1/file_download/<id> endpoint, streaming file_size bytes.
+    """
+
+    async def get(self, file_id):
+        if not self.check_access_token():
+            return
+        self.state.count('file')
+
+        self.set_header('Content-Disposition', 'attachment; filename="bench_file_' + file_id + '.bin";')
+
+        remaining = self.state.file_size
+        chunk = self.state.file_chunk
+        while remaining > 0:
+            self.write( chunk[:remaining] )
+            remaining -= len(chunk)
+            await self.flush()
+
+
+class _SimulatedUserShutil(object):
+    """
+    Stands in for the shutil module inside the bridge, since the simulated users don't exist on this machine.  Files
+    are still chown'd, but to whoever is running the benchmark.
+    """
+
+    def __getattr__(self, name):
+        return getattr(shutil, name)
+
+    def chown(self, path, user=None, group=None):
+        shutil.chown(path, getpass.getuser(), grp.getgrgid( os.getgid() ).gr_name)
+
+
+class Services(object):
+    """
+    Runs the stub ODR server, the OAuth manager and the bridge on their own IOLoop in a background thread.
+    """
+
+    def __init__(self, state, workdir):
+        self.state = state
+        self.workdir = workdir
+        self.ready = threading.Event()
+        self.error = None
+
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        if self.error is not None:
+            raise self.error
+
+
+    def _listen(self, app):
+        sockets = bind_sockets(0, '127.0.0.1')
+        server = HTTPServer(app)
+        server.add_sockets(sockets)
+        return sockets[0].getsockname()[1]
+
+
+    def _run(self):
+        asyncio.set_event_loop( asyncio.new_event_loop() )
+        self.loop = IOLoop.current()
+
+        try:
+            stub_args = dict(state=self.state)
+            self.odr_port = self._listen( Application([
+                (r"/oauth/v2/token", StubTokenHandler, stub_args),
+                (r"/api/v1/databases/(\d+)/records\.json", StubRecordListHandler, stub_args),
+                (r"/api/v1/records/(\d+)\.json", StubRecordHandler, stub_args),
+                (r"/api/v1/file_download/(\d+)", StubFileHandler, stub_args),
+            ]) )
+            self.odr_baseurl = 'http://127.0.0.1:' + str(self.odr_port)
+
+            # The services read their configuration from the environment, the same as when JupyterHub starts them
+            os.environ.update({
+                'oauth_client_id': 'bench_client',
+                'oauth_client_secret': 'bench_secret',
+                'oauth_token_url': self.odr_baseurl + '/oauth/v2/token',
+                'oauth_manager_token': secrets.token_hex(32),
+                'bridge_token': secrets.token_hex(32),
+            })
+
+            import odr_oauth_manager
+            os.environ['JUPYTERHUB_SERVICE_PREFIX'] = '/services/odr_oauth_manager'
+            self.manager_app = odr_oauth_manager.make_app()
+            self.manager_port = self._listen(self.manager_app)
+
+            import odr_bridge
+            odr_bridge.USER_HOME_DIR = os.path.join(self.workdir, 'home') + '/'
+            odr_bridge.shutil = _SimulatedUserShutil()
+            odr_bridge.NOTEBOOK_PLUGINS['bench'] = {'path': os.path.join(self.workdir, 'template.ipynb'), 'language': 'python', 'extension': '.ipynb'}
+            os.environ['JUPYTERHUB_SERVICE_PREFIX'] = '/services/odr_bridge'
+            self.bridge_app = odr_bridge.make_app()
+            self.bridge_port = self._listen(self.bridge_app)
+        except Exception as e:
+            self.error = e
+            self.ready.set()
+            return
+
+        self.ready.set()
+        self.loop.start()
+
+
+    def manager_url(self, path):
+        return 'http://127.0.0.1:' + str(self.manager_port) + '/services/odr_oauth_manager' + path
+
+
+    def bridge_url(self, path):
+        return 'http://127.0.0.1:' + str(self.bridge_port) + '/services/odr_bridge' + path
+
+
+    def register_user(self, username):
+        """
+        Stores a new access/refresh_token pair for username with the OAuth manager, the same way the authenticator does.
+
+        Returns the user_session_token for the new user.
+        """
+
+        tokens = self.state.issue_tokens()
+        session_token = secrets.token_hex(32)
+        r = requests.post(self.manager_url('/create_user'), data=json.dumps({
+            'api_auth_token': os.environ['oauth_manager_token'],
+            'access_token': tokens['access_token'],
+            'refresh_token': tokens['refresh_token'],
+            'expires_in': tokens['expires_in'],
+            'user_session_token': session_token,
+            'username': username,
+        }))
+        r.raise_for_status()
+
+        return session_token
+
+
+def timed_calls(operation, items, concurrency):
+    """
+    Calls operation(item) for every item, with up to concurrency calls running at the same time.
+
+    Returns a dict with the latency of each call, the number of errors and the wall-clock time.
+    """
+
+    def timed(item):
+        start = time.perf_counter()
+        try:
+            operation(item)
+            error = False
+        except Exception:
+            error = True
+        return time.perf_counter() - start, error
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list( executor.map(timed, items) )
+    wall = time.perf_counter() - start
+
+    return {'latencies': [r[0] for r in results], 'errors': sum(1 for r in results if r[1]), 'wall': wall}
+
+
+def run_load(operation, items, concurrency):
+    """
+    Calls operation(item) for every item, with up to concurrency calls running at the same time.
+
+    Returns a dict summarizing the latencies and throughput.
+    """
+
+    result = timed_calls(operation, items, concurrency)
+    return summarize(result['latencies'], result['wall'], result['errors'])
+
+
+def summarize(latencies, wall, errors=0, ops=None):
+    # Batch calls only have a single wall time, so they pass latencies=None and the number of items as ops, and only
+    #  get throughput reported instead of made up percentiles
+    if latencies is None:
+        return {'ops': ops, 'errors': errors, 'wall_s': wall, 'ops_per_s': ops / wall if wall > 0 else 0.0, 'p50_ms': None, 'p95_ms': None, 'p99_ms': None}
+
+    latencies = sorted(latencies)
+
+    def percentile(p):
+        if not latencies:
+            return 0.0
+        return latencies[ min(len(latencies) - 1, int(p / 100.0 * len(latencies))) ]
+
+    return {
+        'ops': len(latencies),
+        'errors': errors,
+        'wall_s': wall,
+        'ops_per_s': len(latencies) / wall if wall > 0 else 0.0,
+        'p50_ms': percentile(50) * 1000,
+        'p95_ms': percentile(95) * 1000,
+        'p99_ms': percentile(99) * 1000,
+    }
+
+
+def summarize_users(user_results):
+    """
+    Combines the timed_calls()-style results from every simulated user into one summary.  The users all start at the
+    same time, so the slowest user's wall-clock time is the wall-clock time of the whole run.
+    """
+
+    wall = max(r['wall'] for r in user_results)
+    errors = sum(r['errors'] for r in user_results)
+    if any(r['latencies'] is None for r in user_results):
+        return summarize(None, wall, errors, ops=sum(r['ops'] for r in user_results))
+
+    return summarize([latency for r in user_results for latency in r['latencies']], wall, errors)
+
+
+def _format_ms(value):
+    return '%8s' % 'n/a' if value is None else '%8.2fms' % value
+
+
+def report(results, scenario, params, summary, **extra):
+    summary = dict(summary)
+    summary.update(extra)
+    results.append({'scenario': scenario, 'params': params, 'results': summary})
+
+    line = '%-18s %-28s ops=%-6d err=%-4d wall=%7.3fs %9.1f ops/s  p50=%s p95=%s p99=%s' % (
+        scenario, ' '.join(k + '=' + str(v) for k, v in params.items()),
+        summary['ops'], summary['errors'], summary['wall_s'], summary['ops_per_s'],
+        _format_ms(summary['p50_ms']), _format_ms(summary['p95_ms']), _format_ms(summary['p99_ms']),
+    )
+    for k, v in extra.items():
+        line += '  ' + k + '=' + (('%.1f' % v) if isinstance(v, float) else str(v))
+    print(line, flush=True)
+
+
+def bench_token_lookup(services, args, results):
+    for num_users in args.users:
+        sessions = [services.register_user('bench_user_' + str(i)) for i in range(num_users)]
+        for concurrency in args.concurrency:
+            items = [sessions[i % num_users] for i in range(args.requests)]
+            with requests.Session() as session:
+                summary = run_load(lambda s: session.get(services.manager_url('/get_access_token/' + s)).raise_for_status(), items, concurrency)
+            report(results, 'token_lookup', {'users': num_users, 'concurrency': concurrency}, summary)
+
+
+def bench_token_refresh(services, args, results):
+    state = services.state
+    for num_users in args.users:
+        for concurrency in args.concurrency:
+            sessions = [services.register_user('bench_refresh_' + str(i)) for i in range(num_users)]
+
+            # Every user sends `concurrency` simultaneous refresh requests, which the manager should coalesce
+            items = [s for s in sessions for _ in range(concurrency)]
+            grants_before = state.counts.get('refresh_grants', 0)
+            with requests.Session() as session:
+                def refresh(s):
+                    r = session.get(services.manager_url('/get_new_access_token/' + s))
+                    r.raise_for_status()
+                    if 'access_token' not in r.json():
+                        raise RuntimeError(r.text)
+                summary = run_load(refresh, items, min(256, len(items)))
+            grants = state.counts.get('refresh_grants', 0) - grants_before
+            report(results, 'token_refresh', {'users': num_users, 'concurrency': concurrency}, summary, upstream_grants=grants)
+
+
+class SimulatedUsers(object):
+    """
+    Runs odr_env for several users at once, each in its own process the same way every user's notebook has its own
+    kernel...odr_env keeps a single user's access token in module globals, so the users can't share a process.
+    """
+
+    def __init__(self, services, num_users):
+        self.env = {'ODR_BASEURL': services.odr_baseurl, 'OAUTH_MANAGER_PORT': str(services.manager_port)}
+        self.sessions = [services.register_user('bench_user_' + str(i)) for i in range(num_users)]
+
+        # The services run on a thread in this process, which makes forking unsafe
+        context = multiprocessing.get_context('spawn')
+        self.manager = context.Manager()
+        self.executor = ProcessPoolExecutor(max_workers=num_users, mp_context=context)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.executor.shutdown()
+        self.manager.shutdown()
+
+
+    def run(self, worker, *worker_args):
+        """
+        Calls worker(odr_env, *worker_args) as every user at the same time.
+
+        Returns a list of the results from each user's call.
+        """
+
+        # Process startup and imports shouldn't count towards the first users' times
+        barrier = self.manager.Barrier( len(self.sessions) )
+        futures = [self.executor.submit(_run_as_user, self.env, session, barrier, worker, worker_args) for session in self.sessions]
+        return [future.result() for future in futures]
+
+
+def _run_as_user(env, session_token, barrier, worker, worker_args):
+    os.environ.update(env)
+    os.environ['OAUTH_SESSION_TOKEN'] = session_token
+
+    # The process could have been running another user's calls before this
+    import odr_env
+    odr_env._access_token = None
+    odr_env._access_token_expires_at = None
+    odr_env.disableCache()
+
+    barrier.wait()
+    return worker(odr_env, *worker_args)
+
+
+def _listing_worker(odr_env, page_size, concurrency, num_records):
+    first_items = []
+
+    def listing(_):
+        start = time.perf_counter()
+        if page_size is None:
+            count = len( odr_env.getDatarecordList(1)['records'] )
+        else:
+            count = 0
+            for item in odr_env.iterDatarecords(1, page_size=page_size, with_data=False):
+                if count == 0:
+                    first_items.append(time.perf_counter() - start)
+                count += 1
+
+        if count != num_records:
+            raise RuntimeError('expected ' + str(num_records) + ' records, got ' + str(count))
+
+    tracemalloc.start()
+    result = timed_calls(listing, range(concurrency), concurrency)
+    result['peak'] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    result['first_items'] = first_items
+    return result
+
+
+def _record_fetch_worker(odr_env, ids, concurrency):
+    if concurrency is None:
+        return timed_calls(odr_env.getDatarecordData, ids, 1)
+
+    start = time.perf_counter()
+    fetched = odr_env.getDatarecordDataMany(ids, max_workers=concurrency)
+    wall = time.perf_counter() - start
+    return {'latencies': None, 'ops': len(ids), 'errors': sum(1 for f in fetched if f['error'] is not None), 'wall': wall}
+
+
+def _download_worker(odr_env, output):
+    return timed_calls(lambda file_id: odr_env.downloadFile(file_id, output=output), [1], 1)
+
+
+def _download_to_disk_worker(odr_env, workdir, num_files, concurrency):
+    cwd = os.getcwd()
+    directory = tempfile.mkdtemp(dir=workdir)
+    os.chdir(directory)
+    try:
+        # downloadFilesToDisk() prints a line for every file
+        with contextlib.redirect_stdout( io.StringIO() ):
+            start = time.perf_counter()
+            downloaded = odr_env.downloadFilesToDisk(list( range(1, num_files + 1) ), max_workers=concurrency)
+            wall = time.perf_counter() - start
+
+        return {'latencies': None, 'ops': num_files, 'errors': sum(1 for d in downloaded if d['error'] is not None), 'wall': wall}
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_listing(services, args, results):
+    for num_users in args.users:
+        with SimulatedUsers(services, num_users) as users:
+            for page_size in (None, 1000, 10000):
+                for concurrency in args.concurrency:
+                    user_results = users.run(_listing_worker, page_size, concurrency, services.state.num_records)
+
+                    params = {'users': num_users, 'concurrency': concurrency, 'method': 'getDatarecordList'}
+                    extra = {'peak_mb': max(r['peak'] for r in user_results) / 1048576.0}
+                    if page_size is not None:
+                        params['method'] = 'iterDatarecords'
+                        params['page_size'] = page_size
+                        first_items = sorted(t for r in user_results for t in r['first_items'])
+                        extra['first_ms'] = first_items[len(first_items) // 2] * 1000 if first_items else 0.0
+                    report(results, 'listing', params, summarize_users(user_results), **extra)
+
+
+def bench_record_fetch(services, args, results):
+    ids = list( range(1, args.fetch_records + 1) )
+
+    for num_users in args.users:
+        with SimulatedUsers(services, num_users) as users:
+            user_results = users.run(_record_fetch_worker, ids, None)
+            report(results, 'record_fetch', {'users': num_users, 'method': 'sequential'}, summarize_users(user_results))
+
+            for concurrency in args.concurrency:
+                user_results = users.run(_record_fetch_worker, ids, concurrency)
+                report(results, 'record_fetch', {'users': num_users, 'concurrency': concurrency, 'method': 'getDatarecordDataMany'}, summarize_users(user_results))
+
+
+def bench_file_download(services, args, results):
+    size_mb = services.state.file_size / 1048576.0
+
+    for num_users in args.users:
+        with SimulatedUsers(services, num_users) as users:
+            # Every user downloads one copy of the file into memory at the same time
+            for output in ('bytes', 'memoryview', 'mmap'):
+                summary = summarize_users( users.run(_download_worker, output) )
+                report(results, 'file_download', {'users': num_users, 'output': output}, summary, mb_per_s=size_mb * summary['ops'] / summary['wall_s'])
+
+            for concurrency in args.concurrency:
+                summary = summarize_users( users.run(_download_to_disk_worker, services.workdir, args.files, concurrency) )
+                report(results, 'file_download', {'users': num_users, 'concurrency': concurrency, 'method': 'downloadFilesToDisk'}, summary, mb_per_s=size_mb * summary['ops'] / summary['wall_s'])
+
+
+def bench_notebook_creation(services, args, results):
+    for num_users in args.users:
+        usernames = ['bench_user_' + str(i) for i in range(num_users)]
+        for username in usernames:
+            os.makedirs(os.path.join(services.workdir, 'home', username), exist_ok=True)
+
+        # The notebooks are spread across the users, with every user creating at least one
+        items = [usernames[i % num_users] for i in range( max(args.notebooks, num_users) )]
+
+        with requests.Session() as session:
+            for list_size in (100, args.large_list):
+                datarecord_list = ','.join( str(i) for i in range(1, list_size + 1) )
+                for concurrency in args.concurrency:
+                    def create(username):
+                        r = session.post(services.bridge_url('/create_notebook'), data={
+                            'bridge_token': os.environ['bridge_token'],
+                            'username': username,
+                            'plugin_name': 'bench',
+                            'datarecord_list': datarecord_list,
+                        })
+                        r.raise_for_status()
+                    summary = run_load(create, items, concurrency)
+                    report(results, 'notebook_creation', {'users': num_users, 'ids': list_size, 'concurrency': concurrency}, summary)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the ODR JupyterHub services against a local stub of ODR.')
+    parser.add_argument('--scenarios', default='all', help='comma-separated list of: all, ' + ', '.join(SCENARIOS))
+    parser.add_argument('--users', default='1,10,100', help='comma-separated numbers of simulated users')
+    parser.add_argument('--concurrency', default='1,8,32', help='comma-separated numbers of simultaneous requests')
+    parser.add_argument('--requests', type=int, default=500, help='number of token lookups per combination')
+    parser.add_argument('--records', type=int, default=100000, help='number of datarecords in the stub datatype')
+    parser.add_argument('--fetch-records', type=int, default=200, help='number of datarecords fetched individually')
+    parser.add_argument('--file-size-mb', type=float, default=64, help='size of each stub file')
+    parser.add_argument('--files', type=int, default=8, help='number of files downloaded to disk at once')
+    parser.add_argument('--notebooks', type=int, default=50, help='number of notebooks created per combination')
+    parser.add_argument('--large-list', type=int, default=50000, help='number of datarecord ids in the large notebook export')
+    parser.add_argument('--token-lifetime', type=int, default=5, help='seconds before the stub expires an access token')
+    parser.add_argument('--latency-ms', type=float, default=10, help='simulated network latency added to every stub ODR response')
+    parser.add_argument('--json', help='also write the results to this file as JSON')
+    parser.add_argument('--show-metrics', action='store_true', help='print the full metrics of the manager and bridge')
+    args = parser.parse_args()
+
+    args.users = [int(u) for u in args.users.split(',')]
+    args.concurrency = [int(c) for c in args.concurrency.split(',')]
+    scenarios = SCENARIOS if args.scenarios == 'all' else args.scenarios.split(',')
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            parser.error('unknown scenario "' + scenario + '"')
+
+    if args.json:
+        args.json = os.path.abspath(args.json)
+
+    # The manager stores its tokens in the working directory, so run everything in a scratch directory
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='odr_bench_')
+    try:
+        os.chdir(workdir)
+        with open('oauth_token_storage.txt', 'w') as f:
+            f.write('{}')
+        nb = nbf.v4.new_notebook()
+        nb['cells'].append( nbf.v4.new_code_cell('print(len(_odr_datarecord_list))') )
+        with open(os.path.join(workdir, 'template.ipynb'), 'w') as f:
+            nbf.write(nb, f)
+
+        state = StubState(args.records, int(args.file_size_mb * 1048576), args.token_lifetime, args.latency_ms / 1000.0)
+        services = Services(state, workdir)
+        services.start()
+
+        results = []
+        for scenario in scenarios:
+            globals()['bench_' + scenario](services, args, results)
+
+        print('\nstub ODR request counts: ' + json.dumps(state.counts, sort_keys=True))
+        for name, url in (('manager', services.manager_url('/metrics')), ('bridge', services.bridge_url('/metrics'))):
+            text = requests.get(url).text
+            if args.show_metrics:
+                print('\n' + text)
+            else:
+                interesting = [line for line in text.splitlines() if not line.startswith('#') and '_bucket' not in line and 'http_' not in line]
+                print(name + ' metrics: ' + '; '.join(interesting))
+
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'args': vars(args), 'results': results, 'stub_counts': state.counts}, f, indent=2)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
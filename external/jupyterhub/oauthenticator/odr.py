@@ -3,16 +3,19 @@ Custom Authenticator to use OAuth2 with ODR
 """
 
 import base64
+import hashlib
 import json
 import os
 import secrets
 import shutil
+import time
 
 from tornado.auth import OAuth2Mixin
 from tornado import gen, web
 
 from tornado.httputil import url_concat
-from tornado.httpclient import HTTPRequest, HTTPClient, AsyncHTTPClient
+from tornado.httpclient import HTTPRequest, AsyncHTTPClient, HTTPError as HTTPClientError
+from tornado.ioloop import IOLoop
 
 from jupyterhub.auth import LocalAuthenticator
 from jupyterhub.handlers import BaseHandler
@@ -39,6 +42,27 @@ class ODRLoginHandler(OAuthLoginHandler, ODREnvMixin):
 class ODROAuthenticator(OAuthenticator):
     pass
 
+# Files copied into each user's directory before their notebook server starts
+USER_FILES = ('odr_env.py', 'odr_env_readme.md')
+USER_FILES_SOURCE_DIR = '/root/'
+
+# Number of attempts, and the timeout for each attempt, when storing a user's tokens with the OAuth manager
+MANAGER_ATTEMPTS = 3
+MANAGER_TIMEOUT = 10
+
+
+def _file_hash(path):
+    """
+    Returns the sha256 hash of the file at path, or None if it doesn't exist.
+    """
+
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha256( f.read() ).hexdigest()
+    except FileNotFoundError:
+        return None
+
+
 class LocalODROAuthenticator(LocalAuthenticator, ODROAuthenticator):
 
     """Uses local system user creation so that ODR is able to define the user list"""
@@ -75,14 +99,21 @@ class LocalODROAuthenticator(LocalAuthenticator, ODROAuthenticator):
 
     access_token = ''
     refresh_token = ''
+    expires_at = None
     odr_baseurl = ''
 
+    # Caches the hashes of the files in USER_FILES_SOURCE_DIR, keyed by path, along with their modification times
+    _source_hashes = {}
+
     # Mechanism for the Authenticator to provide some environment variables for the Spawner
+    @gen.coroutine
     def pre_spawn_start(self, user, spawner):
         # No sense spawning anything if the access/refresh tokens aren't provided
         if self.access_token == '' and self.refresh_token == '':
             raise web.HTTPError(400, "The spawner can't load the necessary access_token and refresh_token parameters...try logging out of JupyterHub, then logging back in.  If the error persists, inform the ODR group about it.")
 
+        start_time = time.perf_counter()
+
         # Set additional environment variables for the soon-to-be-spawned notebook
         oauth_session_token = secrets.token_hex(32)
         spawner.env.update({
@@ -91,33 +122,105 @@ class LocalODROAuthenticator(LocalAuthenticator, ODROAuthenticator):
             'OAUTH_MANAGER_PORT': self.manager_port,
         })
 
+        # The notebook can be spawned long after logging in, so only the remaining lifetime of the access token is sent
+        expires_in = None
+        if self.expires_at is not None:
+            expires_in = max(0, int(self.expires_at - time.time()))
+
         # Build an API request so the OAuth_manager can store the user's data
         params = dict(
             api_auth_token=self.manager_token,
             access_token=self.access_token,
             refresh_token=self.refresh_token,
+            expires_in=expires_in,
 
             username=user.name,
             user_session_token=oauth_session_token,
         )
         params = json.dumps(params)
 
-        req = HTTPRequest(
-            'http://127.0.0.1:' + self.manager_port + '/services/odr_oauth_manager/create_user',
-            method="POST",
-            body=params,
+        # POST this data to the OAuth_manager, and copy a readme and a utility python file into the user's directory
+        #  at the same time...the copying blocks, so it's done off the event loop
+        files_future = IOLoop.current().run_in_executor(None, self.provision_user_files, user.name)
+        yield self.store_manager_tokens(params)
+        manager_duration = time.perf_counter() - start_time
+
+        # Both stages run at the same time, so the copying has to be timed inside the executor
+        copied, files_duration = yield files_future
+
+        self.log.info(
+            "pre_spawn_start for %s: oauth manager %.3fs, user files %.3fs (%d copied), total %.3fs",
+            user.name, manager_duration, files_duration, copied, time.perf_counter() - start_time
         )
 
-        # POST this data to the OAuth_manager
-        http_client = HTTPClient()
-        resp = http_client.fetch(req)
 
-        # Also, copy a readme and a utility python file into the user's directory
-        shutil.copyfile('/root/odr_env.py', '/home/' + user.name + '/odr_env.py')
-        shutil.copystat('/root/odr_env.py', '/home/' + user.name + '/odr_env.py')
+    @gen.coroutine
+    def store_manager_tokens(self, params):
+        """
+        POSTs a user's tokens to the OAuth_manager, retrying a few times if it's unreachable or returns a server error.
+        """
+
+        http_client = AsyncHTTPClient()
+        for attempt in range(1, MANAGER_ATTEMPTS + 1):
+            req = HTTPRequest(
+                'http://127.0.0.1:' + self.manager_port + '/services/odr_oauth_manager/create_user',
+                method="POST",
+                body=params,
+                connect_timeout=MANAGER_TIMEOUT,
+                request_timeout=MANAGER_TIMEOUT,
+            )
+
+            try:
+                resp = yield http_client.fetch(req)
+                return resp
+            except HTTPClientError as e:
+                # 599 means the request never got a response
+                if attempt == MANAGER_ATTEMPTS or (e.code < 500 and e.code != 599):
+                    raise
+                self.log.warning("Attempt %d to reach the oauth manager failed: %s", attempt, e)
+            except OSError as e:
+                if attempt == MANAGER_ATTEMPTS:
+                    raise
+                self.log.warning("Attempt %d to reach the oauth manager failed: %s", attempt, e)
+
+            yield gen.sleep(0.5 * attempt)
+
+
+    def provision_user_files(self, username):
+        """
+        Copies the files in USER_FILES into the user's directory, skipping any that are already identical.
+
+        Returns a tuple of the number of files that were copied, and how many seconds it took.
+        """
+
+        start_time = time.perf_counter()
+        copied = 0
+        for filename in USER_FILES:
+            source = USER_FILES_SOURCE_DIR + filename
+            destination = '/home/' + username + '/' + filename
+
+            if self._get_source_hash(source) == _file_hash(destination):
+                continue
+
+            shutil.copyfile(source, destination)
+            shutil.copystat(source, destination)
+            copied += 1
+
+        return copied, time.perf_counter() - start_time
+
+
+    def _get_source_hash(self, path):
+        """
+        Returns the sha256 hash of one of the files in USER_FILES_SOURCE_DIR, only reading it again if it was modified.
+        """
+
+        mtime = os.stat(path).st_mtime
+        cached = self._source_hashes.get(path)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, _file_hash(path))
+            self._source_hashes[path] = cached
 
-        shutil.copyfile('/root/odr_env_readme.md', '/home/' + user.name + '/odr_env_readme.md')
-        shutil.copystat('/root/odr_env_readme.md', '/home/' + user.name + '/odr_env_readme.md')
+        return cached[1]
 
 
     @gen.coroutine
@@ -159,6 +262,9 @@ class LocalODROAuthenticator(LocalAuthenticator, ODROAuthenticator):
 
         self.access_token = resp_json['access_token']
         self.refresh_token = resp_json['refresh_token']
+        self.expires_at = None
+        if resp_json.get('expires_in') is not None:
+            self.expires_at = time.time() + int(resp_json['expires_in'])
 
         # Get ODR to tell us which user just logged in via OAuth
         headers = {
@@ -8,27 +8,83 @@
 Defines a Tornado web application as a Jupyterhub service that manages creation of notebooks to run on searches done by ODR.
 """
 
+import array
+import copy
 import datetime
 import nbformat as nbf
 import os
 import random
 import shutil
+import time
 
 from tornado.escape import json_decode
 from tornado.gen import coroutine
 from tornado.ioloop import IOLoop
 from tornado.log import app_log
-from tornado.web import Application, HTTPError, RequestHandler
+from tornado.web import Application, HTTPError
 
+from odr_metrics import Metrics, MetricsHandler, MetricsRequestHandler
 
-class BridgeRequestHandler(RequestHandler):
-    pass
+
+# Identifiers of the apps/plugins ODR can request, and the notebooks they use.  'default' is used for any identifier
+#  that isn't listed here.
+NOTEBOOK_PLUGINS = {
+    'app_a': {'path': '/root/jupyterhub_apps/raman_graph_by_sample.ipynb', 'language': 'python', 'extension': '.ipynb'},
+    'app_b': {'path': '/root/jupyterhub_apps/raman_graph_by_wavelength.ipynb', 'language': 'python', 'extension': '.ipynb'},
+    'app_c': {'path': '/root/jupyterhub_apps/mars_average_soil_composition.ipynb', 'language': 'python', 'extension': '.ipynb'},
+    'default': {'path': '/root/jupyterhub_apps/raman_graph_by_sample.ipynb', 'language': 'python', 'extension': '.ipynb'},
+}
+
+# Lists of more datarecords than this are written to a separate file next to the notebook, instead of being pasted
+#  into the notebook itself
+SIDECAR_THRESHOLD = 1000
+
+# Directory containing each user's home directory
+USER_HOME_DIR = '/home/'
+
+
+class NotebookTemplateCache(object):
+    """
+    Keeps parsed copies of the notebook templates in memory, so they don't have to be read and parsed for every
+    request.  A template is read again if its modification time changes.
+    """
+
+    def __init__(self, metrics=None):
+        self._templates = {}
+        self.metrics = metrics
+
+    def get(self, path):
+        """
+        Returns a copy of the parsed notebook at path, which the caller is free to modify.
+        """
+
+        mtime = os.stat(path).st_mtime
+        cached = self._templates.get(path)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, nbf.read(path, as_version=4))
+            self._templates[path] = cached
+            if self.metrics is not None:
+                self.metrics.inc('template_cache_misses_total')
+        elif self.metrics is not None:
+            self.metrics.inc('template_cache_hits_total')
+
+        return copy.deepcopy(cached[1])
+
+
+class BridgeRequestHandler(MetricsRequestHandler):
+
+    def initialize(self, template_cache, metrics):
+        self.template_cache = template_cache
+        self.metrics = metrics
 
 
 class CreateNotebook(BridgeRequestHandler):
     """
+    Creates a copy of one of the app notebooks in the requesting user's directory, with the list of datarecords from
+    an ODR search inserted at the top.
     """
 
+    @coroutine
     def post(self):
         # Since request will have the mimetype 'application/x-www-form-urlencoded', have to use tornado.RequestHandler.get_body_argument() instead of tornado.escape.json_decode()
         # They'll automatically throw 400 status codes if the arguments don't exist
@@ -41,58 +97,100 @@ class CreateNotebook(BridgeRequestHandler):
         if not ( self.bridge_token == os.environ['bridge_token'] ):
             raise HTTPError(403)
 
-        # Locate and read the desired notebook
-        notebook_info = self.getNotebookPath(self.plugin_name)
-        nb = nbf.read(notebook_info['path'], as_version=4)
-
-        # Insert any parameters for the new notebook in a cell before the rest of the notebook
-        code = self.getCodeToInsert(notebook_info['language'], self.datarecord_list)
-        nb['cells'].insert(0, nbf.v4.new_code_cell(code))
+        # The list of datarecords ends up in executable code, so ensure it's only numbers
+        try:
+            datarecord_ids = [int(dr_id) for dr_id in self.datarecord_list.split(',') if dr_id.strip() != '']
+        except ValueError:
+            raise HTTPError(400, 'datarecord_list must be a comma-separated list of ids')
 
         # Determine the name for the new notebook
+        notebook_info = self.getNotebookPath(self.plugin_name)
         current_date = datetime.datetime.now().strftime ("%Y%m%d")
         random_id = random.randrange(100000, 999999)
         notebook_name = 'ODR_export_' + current_date + '_' + str(random_id) + notebook_info['extension']
 
+        # Reading, writing and chown-ing files blocks, so do it off the IOLoop
+        yield IOLoop.current().run_in_executor(None, self.writeNotebook, notebook_info, notebook_name, datarecord_ids)
+
+        # Return the name of the new notebook to ODR
+        self.write({'notebook_path': notebook_name})
+
+
+    def writeNotebook(self, notebook_info, notebook_name, datarecord_ids):
+        """
+        Writes a copy of the requested notebook into the user's directory, with the list of datarecords inserted.
+        """
+
+        start_time = time.perf_counter()
+        user_dir = USER_HOME_DIR + self.username + '/'
+        bytes_written = 0
+
+        # Large lists of datarecords go into a compact binary file instead of the notebook
+        sidecar_name = None
+        if len(datarecord_ids) > SIDECAR_THRESHOLD:
+            sidecar_name = os.path.splitext(notebook_name)[0] + '_datarecords.bin'
+            with open(user_dir + sidecar_name, 'wb') as f:
+                array.array('q', datarecord_ids).tofile(f)
+                bytes_written += f.tell()
+            shutil.chown(user_dir + sidecar_name, self.username, self.username)
+
+        # Insert any parameters for the new notebook in a cell before the rest of the notebook
+        nb = self.template_cache.get(notebook_info['path'])
+        code = self.getCodeToInsert(notebook_info['language'], datarecord_ids, sidecar_name)
+        nb['cells'].insert(0, nbf.v4.new_code_cell(code))
+
         # Write the notebook into the user's directory
-        final_path = '/home/' + self.username + '/' + notebook_name
+        final_path = user_dir + notebook_name
         with open(final_path, 'w') as f:
             nbf.write(nb, f)
+            bytes_written += f.tell()
 
         # Change the new notebook's owner so it's automatically trusted
         shutil.chown(final_path, self.username, self.username)
 
-        # Return the name of the new notebook to ODR
-        self.write({'notebook_path': notebook_name})
+        self.metrics.inc('notebooks_created_total', labels={'plugin': self.plugin_name if self.plugin_name in NOTEBOOK_PLUGINS else 'default'})
+        self.metrics.inc('notebook_bytes_written_total', bytes_written)
+        if sidecar_name is not None:
+            self.metrics.inc('sidecar_files_written_total')
+        self.metrics.observe('notebook_write_duration_seconds', time.perf_counter() - start_time)
 
 
     def getNotebookPath(self, plugin_name):
         """
         Given the identifier of some app/plugin/whatever, returns a dict containing the path to the notebook, which language it's written in, and what extension it should use
         """
-        if (plugin_name == 'app_a'):
-            return {'path': '/root/jupyterhub_apps/raman_graph_by_sample.ipynb', 'language': 'python', 'extension': '.ipynb'}
-        elif (plugin_name == 'app_b'):
-            return {'path': '/root/jupyterhub_apps/raman_graph_by_wavelength.ipynb', 'language': 'python', 'extension': '.ipynb'}
-        elif (plugin_name == 'app_c'):
-            return {'path': '/root/jupyterhub_apps/mars_average_soil_composition.ipynb', 'language': 'python', 'extension': '.ipynb'}
+        if plugin_name in NOTEBOOK_PLUGINS:
+            return NOTEBOOK_PLUGINS[plugin_name]
         else:
-            return {'path': '/root/jupyterhub_apps/raman_graph_by_sample.ipynb', 'language': 'python', 'extension': '.ipynb'}
+            return NOTEBOOK_PLUGINS['default']
 
 
-    def getCodeToInsert(self, notebook_language, datarecord_list):
+    def getCodeToInsert(self, notebook_language, datarecord_ids, sidecar_name=None):
         """
         Returns a string of code to insert at the beginning of the rewritten notebook, so it has access to the correct variables to do its job
         """
         if (notebook_language == 'python'):
-            return "_odr_datarecord_list = [" + datarecord_list + "]"
+            if sidecar_name is None:
+                return "_odr_datarecord_list = [" + ",".join( str(dr_id) for dr_id in datarecord_ids ) + "]"
+            else:
+                return "\n".join([
+                    "import array as _odr_array",
+                    "_odr_datarecord_list = _odr_array.array('q')",
+                    "with open(" + repr(sidecar_name) + ", 'rb') as _odr_file:",
+                    "    _odr_datarecord_list.frombytes(_odr_file.read())",
+                    "_odr_datarecord_list = _odr_datarecord_list.tolist()",
+                ])
 
 
 def make_app():
+    metrics = Metrics('odr_bridge')
+    handler_args = dict(template_cache=NotebookTemplateCache(metrics), metrics=metrics)
+
     # All registered urls MUST be prefixed with os.environ['JUPYTERHUB_SERVICE_PREFIX']
     return Application([
-        ( os.environ['JUPYTERHUB_SERVICE_PREFIX'] + "/create_notebook", CreateNotebook),
-    ])
+        ( os.environ['JUPYTERHUB_SERVICE_PREFIX'] + "/create_notebook", CreateNotebook, handler_args),
+        ( os.environ['JUPYTERHUB_SERVICE_PREFIX'] + "/metrics", MetricsHandler, dict(metrics=metrics)),
+    ], metrics=metrics)
 
 if __name__ == '__main__':
     app = make_app()
@@ -11,34 +11,171 @@ The authenticator should automatically create this file for each user...
 Will (hopefully) be rendered obsolete by https://github.com/jupyterhub/jupyterhub/pull/938 , whenever that is done.
 """
 
+import asyncio
+import collections
+import hashlib
 import json
+import mmap
 import os
-import random
 import requests
 import shutil
-import string
+import tempfile
+import threading
+import time
 
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
 from tornado.httputil import url_concat
+from urllib.parse import urlencode
 
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
-# Found at http://stackoverflow.com/a/2257449
-def _id_generator(size=15, chars=string.ascii_letters + string.digits):
-    return ''.join(random.choice(chars) for _ in range(size))
+
+# Number of keep-alive connections to ODR that the shared session is allowed to hold open at once
+_POOL_MAXSIZE = 32
+
+# Default number of simultaneous requests made by the batch functions
+_DEFAULT_MAX_WORKERS = 8
+
+# Default number of datarecords requested at a time by iterDatarecords()
+_DEFAULT_PAGE_SIZE = 500
+
+# Seconds before the reported expiry time that a cached access token stops being used
+_TOKEN_EXPIRY_MARGIN = 30
+
+_session = None
+_session_lock = threading.Lock()
+
+# The access token is cached for the lifetime of the kernel, instead of asking the OAuth manager for it on every request
+_access_token = None
+_access_token_expires_at = None
+_failed_refresh = None
+_refresh_attempts = 0
+_token_lock = threading.Lock()
+
+# Defaults for the optional response cache...see enableCache()
+_DEFAULT_CACHE_MAX_SIZE = 1024 * 1024 * 1024
+_DEFAULT_CACHE_TTL = 600
+
+# Response headers worth keeping for cached file downloads
+_CACHED_FILE_HEADERS = ('Content-Disposition', 'Content-Length', 'Content-Type')
+
+# None while the response cache is disabled
+_cache_settings = None
+_cache_stats = {'hits': 0, 'revalidations': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+_cache_lock = threading.Lock()
+
+
+def _getSession():
+    """
+    Returns the requests.Session shared by every call in this module, creating it if necessary.
+
+    Reusing a single session means repeated API calls reuse already-open connections instead of paying for a new
+    TCP handshake each time.  requests.Session is safe to share between threads for simple GET requests like these.
+    """
+
+    global _session
+
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=_POOL_MAXSIZE)
+
+                session = requests.Session()
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _session = session
+
+    return _session
 
 
 def __getAccessToken():
     """
-    Contacts the oauth token manager to get this user's access_token
+    Returns this user's access_token as a string.
 
-    Returns the access_token as a string
+    The token is only requested from the oauth token manager the first time this is called.  After that, the cached copy
+    is reused until either ODR reports that it has expired (see __renewAccessToken()), or the expiry time the token
+    manager reported for it has passed.
     """
 
-    r = requests.get( 'http://127.0.0.1:' + os.environ['OAUTH_MANAGER_PORT'] + '/services/odr_oauth_manager/get_access_token/' + os.environ['OAUTH_SESSION_TOKEN'] )
-    if (r.status_code != 200):
-        raise RuntimeError( r.json() )
+    with _token_lock:
+        if _access_token is None:
+            r = _getSession().get( 'http://127.0.0.1:' + os.environ['OAUTH_MANAGER_PORT'] + '/services/odr_oauth_manager/get_access_token/' + os.environ['OAUTH_SESSION_TOKEN'] )
+            if (r.status_code != 200):
+                raise RuntimeError( r.json() )
 
-    data = json.loads(r.text)
-    return data['access_token']
+            __storeAccessToken( json.loads(r.text) )
+
+        elif _access_token_expires_at is not None and time.monotonic() >= _access_token_expires_at:
+            # Known to have expired, so don't bother sending it to ODR first
+            result = __useRefreshToken()
+            if 'access_token' not in result:
+                raise RuntimeError( result )
+
+            __storeAccessToken(result)
+
+        return _access_token
+
+
+def __storeAccessToken(data):
+    """
+    Caches the access_token (and its expiry time, if one was provided) from a response by the oauth token manager.
+
+    Must be called while _token_lock is held.
+    """
+
+    global _access_token, _access_token_expires_at
+
+    _access_token = data['access_token']
+    _access_token_expires_at = None
+    if 'expires_in' in data and data['expires_in'] is not None:
+        # Short-lived tokens would otherwise be considered expired as soon as they arrive
+        expires_in = int(data['expires_in'])
+        _access_token_expires_at = time.monotonic() + expires_in - min(_TOKEN_EXPIRY_MARGIN, expires_in // 2)
+
+
+def __renewAccessToken(expired_token):
+    """
+    Called when ODR claims that expired_token has expired.  Only one thread at a time is allowed to use the refresh
+    token...any other thread that hits the same expired token waits for that attempt to finish, and then receives its
+    result instead of sending a refresh_token request of its own.  Otherwise, the concurrent requests would each
+    invalidate the refresh token that the previous one received.
+
+    A failed attempt is only shared with the threads that were already waiting on it...later calls try again, since the
+    failure could have been temporary (e.g. the OAuth provider being unreachable).
+
+    Returns the same kind of dict that __useRefreshToken() does.
+    """
+
+    global _access_token, _access_token_expires_at, _failed_refresh, _refresh_attempts
+
+    attempts_seen = _refresh_attempts
+
+    with _token_lock:
+        if _access_token is not None and _access_token != expired_token:
+            # Some other thread already got a new access token while this one was waiting
+            return {'access_token': _access_token}
+        if _refresh_attempts != attempts_seen and _failed_refresh is not None:
+            # Some other thread tried and failed to get a new access token while this one was waiting, so don't try again
+            return _failed_refresh
+
+        result = __useRefreshToken()
+        _refresh_attempts += 1
+        if 'access_token' in result:
+            __storeAccessToken(result)
+            _failed_refresh = None
+        else:
+            _failed_refresh = result
+
+            # Forget the access token, so the next call asks the oauth token manager for one again
+            _access_token = None
+            _access_token_expires_at = None
+
+        return result
 
 
 def __useRefreshToken():
@@ -49,7 +186,7 @@ def __useRefreshToken():
       notify that the refresh token has expired.  Or some other error entirely.
     """
 
-    r = requests.get( 'http://127.0.0.1:' + os.environ['OAUTH_MANAGER_PORT'] + '/services/odr_oauth_manager/get_new_access_token/' + os.environ['OAUTH_SESSION_TOKEN'] )
+    r = _getSession().get( 'http://127.0.0.1:' + os.environ['OAUTH_MANAGER_PORT'] + '/services/odr_oauth_manager/get_new_access_token/' + os.environ['OAUTH_SESSION_TOKEN'] )
     if (r.status_code != 200):
         raise RuntimeError( r.json() )
 
@@ -185,6 +322,632 @@ def getDatarecordData(datarecord_id, display_metadata=False):
     return _makeRequest(api_url, file_format, params)
 
 
+def getDatarecordDataMany(datarecord_ids, display_metadata=False, max_workers=_DEFAULT_MAX_WORKERS):
+    """
+    Attempts to download JSON representations of several datarecords from ODR, running up to max_workers requests
+    at the same time.
+
+    Returns a list with one dict per datarecord, in the same order as datarecord_ids.  Each dict has the keys 'id',
+      'data' and 'error'...'error' is None if the datarecord was downloaded, or the exception raised if it wasn't.
+    """
+
+    # Ensure arguments are valid
+    datarecord_ids = _validateIdList(datarecord_ids, 'datarecord_ids')
+    if not isinstance(max_workers, int) or max_workers < 1:
+        raise ValueError('max_workers must be a positive integer')
+
+    return _fetchMany(getDatarecordData, datarecord_ids, max_workers, display_metadata)
+
+
+async def getDatarecordDataManyAsync(datarecord_ids, display_metadata=False, max_workers=_DEFAULT_MAX_WORKERS):
+    """
+    Identical to getDatarecordDataMany(), but can be awaited from inside an already running event loop (such as the
+    one a Jupyter Notebook uses) without blocking it.
+
+    Returns a list with one dict per datarecord, in the same order as datarecord_ids.
+    """
+
+    # Ensure arguments are valid
+    datarecord_ids = _validateIdList(datarecord_ids, 'datarecord_ids')
+    if not isinstance(max_workers, int) or max_workers < 1:
+        raise ValueError('max_workers must be a positive integer')
+
+    return await _fetchManyAsync(getDatarecordData, datarecord_ids, max_workers, display_metadata)
+
+
+def iterDatarecords(datatype_id, page_size=_DEFAULT_PAGE_SIZE, with_data=True, display_metadata=False, max_workers=_DEFAULT_MAX_WORKERS, incremental=False):
+    """
+    Iterates over all datarecords the user can see in a given datatype, requesting page_size datarecords at a time
+    from ODR.  The next page is downloaded in the background while the current page is being worked on, so only about
+    two pages are held in memory at any time.
+
+    If with_data is False, then each item is a dict from the brief listing that getDatarecordList() returns.  Otherwise,
+      each item is a dict with the keys 'id', 'data' and 'error', as returned by getDatarecordDataMany().
+    If incremental is True, then each page of the listing is parsed directly from the network stream instead of
+      being read into a string first.  This requires the ijson package.
+    """
+
+    # Ensure arguments are valid
+    if not isinstance(datatype_id, int):
+        raise ValueError('datatype_id must be numeric')
+    if not isinstance(page_size, int):
+        raise ValueError('page_size must be numeric')
+    if (page_size < 1 or page_size > 999999999):
+        raise ValueError('page_size must be a positive non-zero integer less than 1,000,000,000')
+    if not isinstance(with_data, bool):
+        raise ValueError('with_data must be a boolean')
+    if not isinstance(max_workers, int) or max_workers < 1:
+        raise ValueError('max_workers must be a positive integer')
+    if incremental and ijson is None:
+        raise ImportError('incremental parsing requires the ijson package')
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        offset = 0
+        next_page = executor.submit(_loadDatarecordPage, datatype_id, offset, page_size, with_data, display_metadata, max_workers, incremental)
+
+        while next_page is not None:
+            page = next_page.result()
+
+            # A short page means there's nothing left to request
+            offset += page_size
+            next_page = None
+            if page['count'] == page_size:
+                next_page = executor.submit(_loadDatarecordPage, datatype_id, offset, page_size, with_data, display_metadata, max_workers, incremental)
+
+            for item in page['items']:
+                yield item
+
+            # Release the current page before waiting on the next one
+            page = None
+    finally:
+        executor.shutdown(wait=False)
+
+
+def _loadDatarecordPage(datatype_id, offset, limit, with_data, display_metadata, max_workers, incremental):
+    """
+    Downloads one page of the listing for datatype_id, and optionally the data for every datarecord in it.
+
+    Returns a dict with the number of datarecords in the listing under 'count', and the items that iterDatarecords()
+      should yield under 'items'.
+    """
+
+    api_url = os.environ['ODR_BASEURL'] + '/api/v1/databases/' + str(datatype_id) + '/records.json'
+    params = {'offset': offset, 'limit': limit}
+
+    if incremental:
+        records = _makeIncrementalRequest(api_url, params, 'records')
+    else:
+        records = _makeRequest(api_url, 'json', params)['records']
+
+    if not with_data:
+        return {'count': len(records), 'items': records}
+
+    datarecord_ids = [int(dr['internal_id']) for dr in records]
+    return {'count': len(records), 'items': _fetchMany(getDatarecordData, datarecord_ids, max_workers, display_metadata)}
+
+
+def _validateIdList(id_list, argument_name):
+    """
+    Ensures that id_list is an iterable of integers.
+
+    Returns the ids as a list.
+    """
+
+    if isinstance(id_list, (str, bytes, dict)):
+        raise ValueError(argument_name + ' must be a list of numeric ids')
+
+    try:
+        id_list = list(id_list)
+    except TypeError:
+        raise ValueError(argument_name + ' must be a list of numeric ids')
+
+    for item_id in id_list:
+        if not isinstance(item_id, int):
+            raise ValueError(argument_name + ' must be a list of numeric ids')
+
+    return id_list
+
+
+def _fetchOne(function, item_id, *args):
+    """
+    Calls function(item_id, *args), catching any error so one bad id doesn't abort the rest of a batch.
+
+    Returns a dict with the keys 'id', 'data' and 'error'.
+    """
+
+    try:
+        return {'id': item_id, 'data': function(item_id, *args), 'error': None}
+    except Exception as e:
+        return {'id': item_id, 'data': None, 'error': e}
+
+
+def _fetchMany(function, id_list, max_workers, *args):
+    """
+    Runs function(item_id, *args) for every id in id_list on a bounded thread pool.  Every thread shares the same
+    keep-alive session, so the time spent is bounded by max_workers round trips instead of len(id_list) round trips.
+
+    Returns a list of the _fetchOne() results, in the same order as id_list.
+    """
+
+    if len(id_list) == 0:
+        return []
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(id_list))) as executor:
+        futures = [executor.submit(_fetchOne, function, item_id, *args) for item_id in id_list]
+        return [f.result() for f in futures]
+
+
+async def _fetchManyAsync(function, id_list, max_workers, *args):
+    """
+    The asyncio equivalent of _fetchMany()...the blocking requests are handed to a bounded thread pool, and the event
+    loop is free to do other work until they all finish.
+
+    Returns a list of the _fetchOne() results, in the same order as id_list.
+    """
+
+    if len(id_list) == 0:
+        return []
+
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(id_list)))
+    try:
+        futures = [loop.run_in_executor(executor, _fetchOne, function, item_id, *args) for item_id in id_list]
+        return list(await asyncio.gather(*futures))
+    finally:
+        executor.shutdown(wait=False)
+
+
+def enableCache(directory=None, max_size=_DEFAULT_CACHE_MAX_SIZE, ttl=_DEFAULT_CACHE_TTL):
+    """
+    Turns on a cache of ODR's API responses and file downloads, stored on disk so it survives restarting the notebook.
+    Defaults to the directory '~/.cache/odr_env', which is private to the current user.
+
+    Cached responses are checked with ODR before they're reused if ODR provided an ETag or Last-Modified header for
+    them, otherwise they're reused without checking for up to ttl seconds.  Once the cache holds more than max_size
+    bytes, the least recently used responses are deleted.
+    """
+
+    global _cache_settings
+
+    if directory is None:
+        directory = os.path.join(os.path.expanduser('~'), '.cache', 'odr_env')
+
+    # Ensure arguments are valid
+    if not isinstance(max_size, int) or max_size < 1:
+        raise ValueError('max_size must be a positive integer')
+    if not isinstance(ttl, (int, float)) or ttl < 0:
+        raise ValueError('ttl must be a non-negative number')
+
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    # Build an index of the responses already on disk, ordered from least to most recently used, so storing a
+    #  response doesn't need to look at every other file in the cache to find out what to evict
+    entries = []
+    for filename in os.listdir(directory):
+        if filename.endswith('.body'):
+            try:
+                stat = os.stat( os.path.join(directory, filename) )
+            except OSError:
+                continue
+            entries.append( (stat.st_mtime, filename[:-len('.body')], stat.st_size) )
+
+    index = collections.OrderedDict()
+    for last_used, key, filesize in sorted(entries):
+        index[key] = [filesize, last_used]
+
+    settings = {
+        'directory': directory,
+        'max_size': max_size,
+        'ttl': ttl,
+        'index': index,
+        'size': sum(entry[0] for entry in index.values()),
+    }
+    with _cache_lock:
+        _cacheEvict(settings)
+        _cache_settings = settings
+
+
+def disableCache():
+    """
+    Turns off the response cache.  Anything already in the cache stays on disk, and will be used again if the cache
+    is re-enabled.
+    """
+
+    global _cache_settings
+
+    _cache_settings = None
+
+
+def clearCache():
+    """
+    Deletes every response stored in the cache, forcing the next request for each of them to go to ODR.
+
+    Returns the number of responses that were deleted.
+    """
+
+    settings = _cache_settings
+    if settings is None:
+        return 0
+
+    count = 0
+    with _cache_lock:
+        for filename in os.listdir(settings['directory']):
+            if filename.endswith('.json') or filename.endswith('.body') or filename.endswith('.tmp'):
+                os.remove( os.path.join(settings['directory'], filename) )
+                if filename.endswith('.body'):
+                    count += 1
+
+        settings['index'].clear()
+        settings['size'] = 0
+
+    return count
+
+
+def getCacheStats():
+    """
+    Returns a dict with the number of cache hits (responses reused without contacting ODR), revalidations (responses
+    ODR confirmed were still current), misses, stores and evictions since the kernel started, as well as the number of
+    responses currently in the cache and their total size in bytes.
+    """
+
+    settings = _cache_settings
+    with _cache_lock:
+        stats = dict(_cache_stats)
+        stats['entries'] = len(settings['index']) if settings is not None else 0
+        stats['size'] = settings['size'] if settings is not None else 0
+
+    stats['enabled'] = settings is not None
+    return stats
+
+
+def _cacheKey(api_url, params):
+    """
+    Returns the key of the cached response for api_url and params.  The access token is deliberately left out, since
+    it changes without the response changing.
+    """
+
+    key_params = sorted( (k, v) for k, v in params.items() if k != 'access_token' )
+    return hashlib.sha256( (api_url + '?' + urlencode(key_params)).encode('utf8') ).hexdigest()
+
+
+def _cacheLookup(api_url, params):
+    """
+    Returns a dict of metadata about the cached response for api_url and params, or None if the cache is disabled or
+    doesn't have that response.
+    """
+
+    if _cache_settings is None:
+        return None
+
+    key = _cacheKey(api_url, params)
+    meta_path = os.path.join(_cache_settings['directory'], key + '.json')
+    body_path = os.path.join(_cache_settings['directory'], key + '.body')
+
+    try:
+        with open(meta_path, 'r') as handle:
+            meta = json.load(handle)
+    except (OSError, ValueError):
+        return None
+
+    if not os.path.isfile(body_path):
+        return None
+
+    meta['key'] = key
+    meta['meta_path'] = meta_path
+    meta['body_path'] = body_path
+    return meta
+
+
+def _cacheIsFresh(meta):
+    """
+    Returns whether a cached response can be used without checking with ODR first.
+    """
+
+    if meta['etag'] is not None or meta['last_modified'] is not None:
+        return False
+
+    return time.time() - meta['stored_at'] < _cache_settings['ttl']
+
+
+def _cacheConditionalHeaders(meta):
+    """
+    Returns the headers that ask ODR to only send a response if it differs from the cached one.
+    """
+
+    headers = {}
+    if meta is None:
+        return headers
+
+    if meta['etag'] is not None:
+        headers['If-None-Match'] = meta['etag']
+    if meta['last_modified'] is not None:
+        headers['If-Modified-Since'] = meta['last_modified']
+
+    return headers
+
+
+def _cacheUse(meta, revalidated):
+    """
+    Records that a cached response is being used, so it counts as recently used for eviction purposes.
+    """
+
+    now = time.time()
+    try:
+        if revalidated:
+            meta['stored_at'] = now
+            _cacheWriteFile(meta['meta_path'], json.dumps(_cacheMetaToStore(meta)).encode('utf8'))
+        # The modification time is what orders the index the next time the cache is enabled
+        os.utime(meta['body_path'], (now, now))
+    except OSError:
+        pass
+
+    settings = _cache_settings
+    with _cache_lock:
+        if settings is not None and meta['key'] in settings['index']:
+            settings['index'][ meta['key'] ][1] = now
+            settings['index'].move_to_end( meta['key'] )
+
+        if revalidated:
+            _cache_stats['revalidations'] += 1
+        else:
+            _cache_stats['hits'] += 1
+
+
+def _cacheForget(meta):
+    """
+    Removes a cached response from the index after its files turned out to be missing or unreadable.
+    """
+
+    settings = _cache_settings
+    if settings is None:
+        return
+
+    with _cache_lock:
+        entry = settings['index'].pop(meta['key'], None)
+        if entry is not None:
+            settings['size'] -= entry[0]
+
+
+def _cacheMetaToStore(meta):
+    """
+    Returns the parts of the metadata dict that belong in the metadata file.
+    """
+
+    return {k: v for k, v in meta.items() if k not in ('key', 'meta_path', 'body_path')}
+
+
+def _cacheReadBody(meta):
+    """
+    Returns the contents of a cached response, or None if another thread or process deleted it after it was looked up.
+    """
+
+    try:
+        with open(meta['body_path'], 'rb') as handle:
+            return handle.read()
+    except OSError:
+        _cacheForget(meta)
+        return None
+
+
+def _cacheOpenFile(meta):
+    """
+    Returns a _CachedFileResponse for a cached file download, or None if another thread or process deleted it after it
+    was looked up.
+    """
+
+    try:
+        return _CachedFileResponse(meta)
+    except OSError:
+        _cacheForget(meta)
+        return None
+
+
+def _cacheStore(api_url, params, r, body=None, body_tempfile=None):
+    """
+    Stores a successful response in the cache, from either a bytes object or a temporary file in the cache directory.
+    """
+
+    settings = _cache_settings
+    if settings is None:
+        return
+
+    key = _cacheKey(api_url, params)
+    now = time.time()
+    meta = {
+        'url': api_url,
+        'etag': r.headers.get('ETag'),
+        'last_modified': r.headers.get('Last-Modified'),
+        'stored_at': now,
+        'headers': {name: r.headers[name] for name in _CACHED_FILE_HEADERS if name in r.headers},
+    }
+
+    # Write everything to temporary files first, so only the renames need to happen while holding the lock
+    if body_tempfile is None:
+        body_tempfile = _cacheWriteTempFile(settings['directory'], body)
+    filesize = os.path.getsize(body_tempfile)
+    meta_tempfile = _cacheWriteTempFile(settings['directory'], json.dumps(meta).encode('utf8'))
+
+    with _cache_lock:
+        os.replace(body_tempfile, os.path.join(settings['directory'], key + '.body'))
+        os.replace(meta_tempfile, os.path.join(settings['directory'], key + '.json'))
+
+        entry = settings['index'].pop(key, None)
+        if entry is not None:
+            settings['size'] -= entry[0]
+        settings['index'][key] = [filesize, now]
+        settings['size'] += filesize
+
+        _cache_stats['stores'] += 1
+        _cacheEvict(settings)
+
+
+def _cacheWriteTempFile(directory, contents):
+    """
+    Writes the given bytes to a new temporary file in directory.
+
+    Returns the path to the temporary file
+    """
+
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as handle:
+            handle.write(contents)
+    except:
+        os.remove(temp_path)
+        raise
+
+    return temp_path
+
+
+def _cacheWriteFile(path, contents):
+    """
+    Atomically replaces the file at path with the given bytes, so other threads never see a partially written file.
+    """
+
+    temp_path = _cacheWriteTempFile(os.path.dirname(path), contents)
+    try:
+        os.replace(temp_path, path)
+    except:
+        os.remove(temp_path)
+        raise
+
+
+def _cacheEvict(settings):
+    """
+    Deletes the least recently used responses until the cache is no larger than its maximum size.  Must be called while
+    holding _cache_lock.
+    """
+
+    index = settings['index']
+    while settings['size'] > settings['max_size'] and index:
+        key, entry = index.popitem(last=False)
+        settings['size'] -= entry[0]
+
+        for suffix in ('.body', '.json'):
+            try:
+                os.remove( os.path.join(settings['directory'], key + suffix) )
+            except OSError:
+                pass
+
+        _cache_stats['evictions'] += 1
+
+
+class _CachedFileResponse(object):
+    """
+    Stands in for a requests.Response when a file download is served from the cache.  The cached file is opened
+    immediately, so it can still be read if it's evicted before the download finishes.
+    """
+
+    status_code = 200
+
+    def __init__(self, meta):
+        self.headers = CaseInsensitiveDict(meta['headers'])
+        self.handle = open(meta['body_path'], 'rb')
+
+    def iter_content(self, chunk_size=1):
+        try:
+            while True:
+                chunk = self.handle.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            self.handle.close()
+
+    def close(self):
+        self.handle.close()
+
+
+class _CachingFileResponse(object):
+    """
+    Wraps a requests.Response for a file download, and stores a copy of the file in the cache as it's being read.
+    The copy is only kept if the entire file was read.
+    """
+
+    def __init__(self, r, api_url):
+        self.response = r
+        self.api_url = api_url
+        self.status_code = r.status_code
+        self.headers = r.headers
+
+    def iter_content(self, chunk_size=1):
+        fd, temp_path = tempfile.mkstemp(dir=_cache_settings['directory'], suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as handle:
+                for chunk in self.response.iter_content(chunk_size=chunk_size):
+                    handle.write(chunk)
+                    yield chunk
+
+            with _cache_lock:
+                _cache_stats['misses'] += 1
+            if os.path.getsize(temp_path) <= _cache_settings['max_size']:
+                _cacheStore(self.api_url, {}, self.response, body_tempfile=temp_path)
+        finally:
+            if os.path.isfile(temp_path):
+                os.remove(temp_path)
+
+    def close(self):
+        self.response.close()
+
+
+def _cacheFileRequest(api_url, params, headers, cache_meta):
+    """
+    Runs the http request for _makeFileRequest(), asking ODR to only send the file if it differs from the cached copy
+    described by cache_meta.
+
+    Returns the object that _makeFileRequest() should return if the request was successful
+    """
+
+    conditional_headers = dict(headers)
+    conditional_headers.update( _cacheConditionalHeaders(cache_meta) )
+    r = _getSession().get(api_url, params=params, headers=conditional_headers, stream=True)
+
+    if r.status_code == 304 and cache_meta is not None:
+        r.close()
+        cached = _cacheOpenFile(cache_meta)
+        if cached is not None:
+            _cacheUse(cache_meta, True)
+            return cached
+
+        # The cached copy disappeared after it was looked up, so ask for the entire file instead
+        r = _getSession().get(api_url, params=params, headers=headers, stream=True)
+
+    if r.status_code == 200 and _cache_settings is not None:
+        return _CachingFileResponse(r, api_url)
+
+    return r
+
+
+def _cacheJSONRequest(api_url, params, headers, cache_meta):
+    """
+    Runs the http request for _makeRequest(), asking ODR to only send the response if it differs from the cached copy
+    described by cache_meta.  Successful responses are stored in the cache.
+
+    Returns a tuple of the response object and the text that should be parsed for it
+    """
+
+    conditional_headers = dict(headers)
+    conditional_headers.update( _cacheConditionalHeaders(cache_meta) )
+    r = _getSession().get(api_url, params=params, headers=conditional_headers)
+
+    if r.status_code == 304 and cache_meta is not None:
+        body = _cacheReadBody(cache_meta)
+        if body is not None:
+            _cacheUse(cache_meta, True)
+            return r, body.decode('utf8')
+
+        # The cached copy disappeared after it was looked up, so ask for the entire response instead
+        r = _getSession().get(api_url, params=params, headers=headers)
+
+    if r.status_code == 200 and _cache_settings is not None:
+        with _cache_lock:
+            _cache_stats['misses'] += 1
+        _cacheStore(api_url, params, r, body=r.content)
+
+    return r, r.text
+
+
 def _makeRequest(api_url, file_format, params=None):
     """
     Makes a request to the specified api_url, and attempts to deal with any errors that arise.
@@ -192,9 +955,21 @@ def _makeRequest(api_url, file_format, params=None):
     Returns a dict of the request data if successful
     """
 
-    # Get the access token into the request parameters list
     if (params is None):
         params = {}
+
+    # Use a cached copy of the response if possible
+    cache_meta = _cacheLookup(api_url, params)
+    if cache_meta is not None and _cacheIsFresh(cache_meta):
+        body = _cacheReadBody(cache_meta)
+        if body is not None:
+            _cacheUse(cache_meta, False)
+            return json.loads( body.decode('utf8') )
+
+        # The cached copy disappeared after it was looked up, so treat it as a miss
+        cache_meta = None
+
+    # Get the access token into the request parameters list
     params['access_token'] = __getAccessToken()
 
     # Set the correct accept header for the requested file format
@@ -204,19 +979,19 @@ def _makeRequest(api_url, file_format, params=None):
 
 
     # Run the http request
-    r = requests.get(api_url, params=params, headers=accept_header)
+    r, text = _cacheJSONRequest(api_url, params, accept_header, cache_meta)
     # TODO - handle non-json data as well
-    data = json.loads(r.text)
+    data = json.loads(text)
 
     # Deal with the response...
-    if (r.status_code == 200):
+    if (r.status_code == 200 or r.status_code == 304):
         # Nothing went wrong, return the result as a dict
         return data
     elif "error_description" in data:
         # Got an OAuth error, assume it's most likely to be an access token issue...
         if data['error_description'] == 'The access token provided has expired.':
             # Attempt to get a new access token
-            result = __useRefreshToken()
+            result = __renewAccessToken(params['access_token'])
 
             if 'access_token' not in result:
                 # Something happened while trying to get a new access_token, abort
@@ -225,11 +1000,11 @@ def _makeRequest(api_url, file_format, params=None):
                 params['access_token'] = result['access_token']
 
                 # Run the http request again with the new access token
-                r = requests.get(api_url, params=params, headers=accept_header)
+                r, text = _cacheJSONRequest(api_url, params, accept_header, cache_meta)
                 # TODO - handle non-json data as well
-                data = json.loads(r.text)
+                data = json.loads(text)
 
-                if (r.status_code == 200):
+                if (r.status_code == 200 or r.status_code == 304):
                     # Nothing wrong with the second request, return the result as a dict
                     return data
                 elif "error_description" in data:
@@ -248,6 +1023,31 @@ def _makeRequest(api_url, file_format, params=None):
         raise RuntimeError( data )
 
 
+def _makeIncrementalRequest(api_url, params, key):
+    """
+    Makes a JSON request to the specified api_url, and parses the items of the list stored under the given top-level
+    key as they arrive, instead of reading the entire response into memory first.
+
+    Returns the list of items if successful
+    """
+
+    params = dict(params)
+    params['access_token'] = __getAccessToken()
+
+    r = _getSession().get(api_url, params=params, headers={'accept': 'application/json'}, stream=True)
+    try:
+        if (r.status_code == 200):
+            # Ensure any compression applied by the server is undone before the parser sees the data
+            r.raw.decode_content = True
+            return list( ijson.items(r.raw, key + '.item', use_float=True) )
+    finally:
+        r.close()
+
+    # Errors are small, so let _makeRequest() deal with them...including getting a new access token if necessary
+    del params['access_token']
+    return _makeRequest(api_url, 'json', params)[key]
+
+
 def getFileList(datarecord_id):
     """
     Given a top-level datarecord id, returns a dict where that datarecord's data has been reduced to just file information.
@@ -279,35 +1079,254 @@ def _buildFileListJSON(datarecord_list, file_list):
     Returns a dict of file information.
     """
 
-    for dr in datarecord_list['records']:
-        # Grab the name to identify this datarecord by
-        dr_name = dr['record_name']
+    _flattenToColumns(datarecord_list, file_list)
+    return file_list
+
+
+def flattenDatarecords(datarecord_data, infer_types=True):
+    """
+    Converts the nested JSON returned by getDatarecordData() into one table per (child) datatype, so the values can
+    be analyzed with NumPy instead of repeatedly walking the nested dicts.  datarecord_data can also be a list of
+    these dicts, such as the 'data' values returned by getDatarecordDataMany().
+
+    Returns a dict with one entry per datatype name.  Each entry is a dict with the keys:
+      'internal_id':   array of datarecord ids, one per row
+      'record_name':   array of datarecord names
+      'parent_table':  array of the names of the tables holding each datarecord's parent, or None for top-level rows
+      'parent_index':  array of row numbers of each datarecord's parent in its parent table, or -1 for top-level rows
+      'parent_id':     array of datarecord ids of each datarecord's parent, or -1 for top-level rows
+      'fields':        dict of datafield name => array of that datafield's values, with None/NaN where a datarecord
+                       doesn't have a value
+    If infer_types is True, then datafields where every value is a JSON number are converted to int64 or float64 arrays.
+    Values that ODR sends as strings are left alone, even if they look like numbers.
+    File and image datafields hold lists of file dicts, and radio datafields hold lists of selected option names.
+    """
+
+    import numpy
+
+    tables = _flattenToColumns(datarecord_data)
+    for table in tables.values():
+        table['internal_id'] = numpy.array(table['internal_id'], dtype=numpy.int64)
+        table['record_name'] = _toObjectArray(table['record_name'])
+        table['parent_table'] = _toObjectArray(table['parent_table'])
+        table['parent_index'] = numpy.array(table['parent_index'], dtype=numpy.int64)
+        table['parent_id'] = numpy.array(table['parent_id'], dtype=numpy.int64)
+
+        for df_name, values in table['fields'].items():
+            if infer_types and df_name not in table['file_fields']:
+                table['fields'][df_name] = _toTypedArray(values)
+            else:
+                table['fields'][df_name] = _toObjectArray(values)
+
+        del table['field_columns']
+        del table['file_fields']
+
+    return tables
+
+
+def datarecordsToDataFrames(datarecord_data, infer_types=True):
+    """
+    Converts the nested JSON returned by getDatarecordData() into one pandas DataFrame per (child) datatype.  Each
+    DataFrame has 'internal_id', 'record_name' and 'parent_id' columns, followed by one column per datafield...child
+    datarecords can be joined to their parents by matching 'parent_id' against the parent's 'internal_id'.
+
+    Returns a dict of datatype name => DataFrame
+    """
+
+    import pandas
+
+    frames = {}
+    for dt_name, table in flattenDatarecords(datarecord_data, infer_types).items():
+        columns = collections.OrderedDict()
+        columns['internal_id'] = table['internal_id']
+        columns['record_name'] = table['record_name']
+        columns['parent_id'] = table['parent_id']
+        for df_name, values in table['fields'].items():
+            if df_name not in columns:
+                columns[df_name] = values
+
+        frames[dt_name] = pandas.DataFrame(columns)
+
+    return frames
+
+
+def _flattenToColumns(datarecord_data, file_list=None):
+    """
+    Walks the datarecords in datarecord_data (and all their child datarecords) depth first, using an explicit stack
+    so that deeply nested records can't hit python's recursion limit.  Every datarecord is visited exactly once, in the
+    same order as the nested JSON.  If file_list is a dict, then the identifiers for every file are also stored in it,
+    in the format returned by getFileList().
 
-        for df_name, df in dr['fields'].items():
+    Child datarecords are grouped into tables by the datatype name they're listed under in 'child_records'.  The
+    top-level datarecords don't have one, so their table is named after their 'database_name' (or 'database_uuid').
+
+    Returns a dict of datatype name => table, where every column of each table is a plain list.
+    """
+
+    if isinstance(datarecord_data, dict):
+        datarecord_data = [datarecord_data]
+
+    tables = collections.OrderedDict()
+
+    # Each entry is an iterator over a list of datarecords, the name of their datatype (None for top-level datarecords),
+    #  the name of the table holding their parent, and the parent's row/id
+    stack = []
+    for data in reversed(datarecord_data):
+        stack.append( (iter(data['records']), None, None, -1, -1) )
+
+    while stack:
+        records, dt_name, parent_table, parent_index, parent_id = stack[-1]
+        dr = next(records, None)
+        if dr is None:
+            stack.pop()
+            continue
+
+        if dt_name is None:
+            dt_name = dr.get('database_name', dr.get('database_uuid', ''))
+        table = tables.get(dt_name)
+        if table is None:
+            table = {
+                'internal_id': [],
+                'record_name': [],
+                'parent_table': [],
+                'parent_index': [],
+                'parent_id': [],
+                'fields': collections.OrderedDict(),
+                'field_columns': {},
+                'file_fields': set(),
+            }
+            tables[dt_name] = table
+
+        row = len(table['internal_id'])
+        table['internal_id'].append( int(dr['internal_id']) )
+        table['record_name'].append( dr.get('record_name') )
+        table['parent_table'].append(parent_table)
+        table['parent_index'].append(parent_index)
+        table['parent_id'].append(parent_id)
+
+        for df_name, df in dr.get('fields', {}).items():
             # In earlier versions of the spec, the datafield name is a value inside the datafield object
             if 'field_name' in df:
                 df_name = df['field_name']
 
-            if 'files' in df:
+            if 'files' in df and file_list is not None:
                 for f in df['files']:
-                    # Grab the identifiers for each file
-                    f_id = f['id']
-                    f_name = f['original_name']
-
-                    # Store them in the dict
+                    # Store the identifiers for each file in the dict
                     data = dict()
-                    data['filename'] = f_name
+                    data['filename'] = f['original_name']
                     data['datafield_name'] = df_name
-                    data['datarecord_name'] = dr_name
+                    data['datarecord_name'] = dr.get('record_name')
+
+                    file_list[ f['id'] ] = data
+
+            # Each datafield keeps the column it was first given, identified by its id
+            df_id = df.get('id', df_name)
+            column_name = table['field_columns'].get(df_id)
+            if column_name is None:
+                column_name = df_name
+                if column_name in table['fields']:
+                    # Another datafield in this datatype has the same name, so tell the columns apart by id
+                    column_name = df_name + ' (' + str(df_id) + ')'
+                table['field_columns'][df_id] = column_name
+                table['fields'][column_name] = []
+            df_name = column_name
+            column = table['fields'][df_name]
+
+            if 'files' in df:
+                table['file_fields'].add(df_name)
 
-                    file_list[f_id] = data
+            # Datarecords that didn't have this datafield get an empty value
+            if len(column) < row:
+                column.extend( [None] * (row - len(column)) )
+            column.append( _getDatafieldValue(df) )
 
-        # If this datarecord has children, recursively iterate through them looking for files as well
+        # Child datarecords are processed before the next sibling of this datarecord
         if 'child_records' in dr:
-            for child_dt_name, child_dt in dr['child_records'].items():
-                file_list = _buildFileListJSON(child_dt, file_list)
+            for child_dt_name, child_dt in reversed( list(dr['child_records'].items()) ):
+                stack.append( (iter(child_dt['records']), child_dt_name, dt_name, row, int(dr['internal_id'])) )
 
-    return file_list
+    # Ensure every column in a table has one value per row
+    for table in tables.values():
+        num_rows = len(table['internal_id'])
+        for column in table['fields'].values():
+            if len(column) < num_rows:
+                column.extend( [None] * (num_rows - len(column)) )
+
+    return tables
+
+
+def _getDatafieldValue(df):
+    """
+    Returns the value of a single datafield from a datarecord's JSON.
+    """
+
+    if 'files' in df:
+        return df['files']
+    elif 'selected' in df:
+        # Boolean datafields
+        return str(df['selected']) == '1'
+    elif 'tags' in df:
+        return df['tags']
+    elif 'value' in df:
+        value = df['value']
+        if isinstance(value, list):
+            # Radio datafields are a list of the selected options, each wrapped in a dict
+            names = []
+            for option in value:
+                if 'name' in option:
+                    names.append(option['name'])
+                else:
+                    for option_data in option.values():
+                        if isinstance(option_data, dict) and 'name' in option_data:
+                            names.append(option_data['name'])
+            return names
+        return value
+
+    return None
+
+
+def _toObjectArray(values):
+    """
+    Returns a NumPy array of python objects holding the given list, without NumPy trying to turn nested lists into
+    extra dimensions.
+    """
+
+    import numpy
+
+    array = numpy.empty(len(values), dtype=object)
+    array[:] = values
+    return array
+
+
+def _toTypedArray(values):
+    """
+    Returns a bool array if every value in the list is a boolean, an int64 array if every value is an integer, a
+    float64 array (with NaN for missing values) if every value is a JSON number, or an array of python objects
+    otherwise.  Strings are never converted, since values like '00123' aren't necessarily meant to be numbers.
+    """
+
+    import numpy
+
+    present = [value for value in values if value is not None]
+    if len(present) == 0:
+        return _toObjectArray(values)
+
+    if all( isinstance(value, bool) for value in present ):
+        if len(present) == len(values):
+            return numpy.array(values, dtype=bool)
+        return _toObjectArray(values)
+
+    if any( isinstance(value, bool) or not isinstance(value, (int, float)) for value in present ):
+        return _toObjectArray(values)
+
+    if all( isinstance(value, int) for value in present ):
+        if len(present) == len(values) and all( -2**63 <= value < 2**63 for value in present ):
+            return numpy.array(values, dtype=numpy.int64)
+        if not all( abs(value) <= 2**53 for value in present ):
+            # float64 can't hold integers this large exactly
+            return _toObjectArray(values)
+
+    return numpy.array( [numpy.nan if value is None else value for value in values], dtype=numpy.float64 )
 
 
 def downloadImageToDisk(image_id):
@@ -323,27 +1342,7 @@ def downloadImageToDisk(image_id):
 
     # Attempt to download the image from ODR
     api_url = os.environ['ODR_BASEURL'] + '/api/v1/image_download/' + str(image_id)
-    r = _makeFileRequest(api_url)
-
-    # Name of image is stored within the Content-Disposition header, which is 'attachment; filename="<filename>";'
-    filename_header = r.headers['Content-Disposition']
-    final_filename = filename_header[22:-2]
-
-    # Apparently Symfony doesn't send a 'Content-Length' header despite ODR specifying one?
-#    expected_filesize = float(r.headers['Content-Length']) / 1024.0 / 1024.0
-
-    # Download the image from ODR
-    temp_filename = _id_generator() + '.tmp'
-    with open(temp_filename, 'wb') as fd:
-        for chunk in r.iter_content(chunk_size=65536):  # Attempt to read 64kb at a time
-            fd.write(chunk)
-
-    # Rename the downloaded image to match the original name provided by the server
-    shutil.move(temp_filename, final_filename)
-
-    print( 'Saved "' + final_filename + '"' )
-
-    return final_filename
+    return _downloadToDisk(api_url, '.odr_image_' + str(image_id) + '.tmp')
 
 
 def downloadFileToDisk(file_id):
@@ -359,73 +1358,215 @@ def downloadFileToDisk(file_id):
 
     # Attempt to download the file from ODR
     api_url = os.environ['ODR_BASEURL'] + '/api/v1/file_download/' + str(file_id)
-    r = _makeFileRequest(api_url)
+    return _downloadToDisk(api_url, '.odr_file_' + str(file_id) + '.tmp')
 
-    # Name of file is stored within the Content-Disposition header, which is 'attachment; filename="<filename>";'
-    filename_header = r.headers['Content-Disposition']
-    final_filename = filename_header[22:-2]
 
-    # Apparently Symfony doesn't send a 'Content-Length' header despite ODR specifying one?
-#    expected_filesize = float(r.headers['Content-Length']) / 1024.0 / 1024.0
+def downloadFilesToDisk(file_ids, max_workers=4):
+    """
+    Attempts to download several files from ODR into the user's notebook directory, running up to max_workers
+    downloads at the same time.
+
+    Returns a list with one dict per file, in the same order as file_ids.  Each dict has the keys 'id', 'data' and
+      'error'...'data' is the path to the downloaded file, and 'error' is None unless the download failed.
+    """
+
+    # Ensure arguments are valid
+    file_ids = _validateIdList(file_ids, 'file_ids')
+    if not isinstance(max_workers, int) or max_workers < 1:
+        raise ValueError('max_workers must be a positive integer')
+
+    # Each file id has its own temporary file, so a file that's listed twice must only be downloaded once
+    unique_ids = list( dict.fromkeys(file_ids) )
+    results = dict( (result['id'], result) for result in _fetchMany(downloadFileToDisk, unique_ids, max_workers) )
+
+    return [results[file_id] for file_id in file_ids]
+
+
+def _downloadToDisk(api_url, temp_filename):
+    """
+    Streams the file at api_url into temp_filename, and then renames it to match the original name provided by the
+    server.  If temp_filename already exists from an earlier interrupted download, only the rest of the file is
+    requested...but only if the server can confirm, via the ETag or Last-Modified value recorded next to the partial
+    file, that the file hasn't changed since then.
+
+    Returns the path to the downloaded file
+    """
+
+    validator_filename = temp_filename + '.validator'
+
+    resume_from = 0
+    validator = None
+    if os.path.isfile(temp_filename) and os.path.isfile(validator_filename):
+        resume_from = os.path.getsize(temp_filename)
+        with open(validator_filename, 'r') as fd:
+            validator = fd.read()
+
+    r = None
+    if resume_from > 0 and validator:
+        # If-Range makes the server send the whole file instead of the rest of it if the file changed
+        try:
+            r = _makeFileRequest(api_url, {'Range': 'bytes=' + str(resume_from) + '-', 'If-Range': validator})
+        except (RuntimeError, ValueError):
+            # The partial file can't be resumed for some reason (e.g. it's already complete), so start over
+            r = None
+
+    if r is None or r.status_code != 206:
+        # Either there's nothing to resume, or the server is sending the whole file
+        if r is None:
+            r = _makeFileRequest(api_url)
+        resume_from = 0
+
+        # Record which version of the file is being downloaded, so an interrupted download can be resumed safely
+        validator = r.headers.get('ETag') or r.headers.get('Last-Modified')
+        if validator:
+            with open(validator_filename, 'w') as fd:
+                fd.write(validator)
+        elif os.path.isfile(validator_filename):
+            os.remove(validator_filename)
+
+    final_filename = _getResponseFilename(r)
 
     # Download the file from ODR
-    temp_filename = _id_generator() + '.tmp'
-    with open(temp_filename, 'wb') as fd:
+    mode = 'ab' if resume_from > 0 else 'wb'
+    with open(temp_filename, mode) as fd:
         for chunk in r.iter_content(chunk_size=65536):  # Attempt to read 64kb at a time
             fd.write(chunk)
 
     # Rename the downloaded file to match the original name provided by the server
     shutil.move(temp_filename, final_filename)
+    if os.path.isfile(validator_filename):
+        os.remove(validator_filename)
 
     print( 'Saved "' + final_filename + '"' )
 
     return final_filename
 
 
-def downloadFile(file_id):
+def _getResponseFilename(r):
+    """
+    Returns the original name of the file being downloaded in the response object r.
+    """
+
+    # Name of file is stored within the Content-Disposition header, which is 'attachment; filename="<filename>";'
+    filename_header = r.headers['Content-Disposition']
+    return filename_header[22:-2]
+
+
+def downloadFile(file_id, output='bytes', dtype='uint8'):
     """
     Attempts to download the specified file from ODR.
 
-    Returns the contents of the file as a single binary string, since that's easier for NumPy to handle.
+    By default, returns the contents of the file as a single binary string, since that's easier for NumPy to handle.
+    The 'output' argument can also be one of the following, which avoid making a second copy of the file's contents:
+      'memoryview': returns a memoryview over the downloaded bytes
+      'numpy':      returns a read-only NumPy array of the given dtype over the downloaded bytes, via numpy.frombuffer()
+      'mmap':       writes the file into an anonymous temporary file instead of memory, and returns a read-only
+                    mmap.mmap of it...useful for files that are larger than the memory available to the notebook
     """
 
     # Ensure arguments are valid
     if not isinstance(file_id, int):
         raise ValueError('file_id must be numeric')
+    if output not in ('bytes', 'memoryview', 'numpy', 'mmap'):
+        raise ValueError('output must be one of "bytes", "memoryview", "numpy" or "mmap"')
 
     # Attempt to download the file from ODR
     api_url = os.environ['ODR_BASEURL'] + '/api/v1/file_download/' + str(file_id)
     r = _makeFileRequest(api_url)
 
-    # Name of file is stored within the Content-Disposition header, which is 'attachment; filename="<filename>";'
-    filename_header = r.headers['Content-Disposition']
-    final_filename = filename_header[22:-2]
+    if output == 'mmap':
+        return _readResponseToMmap(r)
+
+    file_contents = _readResponseToBuffer(r)
+    if output == 'memoryview':
+        return memoryview(file_contents)
+    elif output == 'numpy':
+        import numpy
+        array = numpy.frombuffer(file_contents, dtype=dtype)
+        array.flags.writeable = False
+        return array
+    else:
+        return bytes(file_contents)
 
-    # Apparently Symfony doesn't send a 'Content-Length' header despite ODR specifying one?
-#    expected_filesize = float(r.headers['Content-Length']) / 1024.0 / 1024.0
 
-    # Download the file from ODR
-    file_contents = b""
+def _readResponseToBuffer(r):
+    """
+    Reads the body of the response object r into a single buffer, in time proportional to the size of the file.  When
+    the server provides a Content-Length header the buffer is allocated once up front, otherwise it grows (with
+    amortized constant cost per byte) as chunks arrive.
+
+    Returns a bytearray
+    """
+
+    # Apparently Symfony doesn't always send a 'Content-Length' header despite ODR specifying one...
+    expected_filesize = 0
+    if r.headers.get('Content-Length') is not None and r.headers.get('Content-Encoding') is None:
+        expected_filesize = int(r.headers['Content-Length'])
+
+    # Assigning a chunk to a slice of the same length overwrites the buffer in place, and a slice that runs past the
+    #  end of the buffer extends it...so this works whether or not the expected filesize was accurate
+    file_contents = bytearray(expected_filesize)
+    position = 0
     for chunk in r.iter_content(chunk_size=65536):  # Attempt to read 64kb at a time
-        file_contents = b"".join([file_contents, chunk])
+        file_contents[position:position + len(chunk)] = chunk
+        position += len(chunk)
 
+    del file_contents[position:]
     return file_contents
 
 
-def _makeFileRequest(api_url):
+def _readResponseToMmap(r):
+    """
+    Writes the body of the response object r into an anonymous temporary file, which is deleted automatically once
+    nothing refers to it anymore.
+
+    Returns a read-only mmap.mmap of the file
     """
-    Attempts to download the specified file from ODR.
+
+    with tempfile.TemporaryFile() as fd:
+        for chunk in r.iter_content(chunk_size=65536):  # Attempt to read 64kb at a time
+            fd.write(chunk)
+        fd.flush()
+
+        if fd.tell() == 0:
+            # Can't mmap an empty file
+            return b""
+
+        # The mapping keeps its own reference to the file, so it's fine to close the file afterwards
+        return mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _makeFileRequest(api_url, headers=None):
+    """
+    Attempts to download the specified file from ODR.  Any extra headers (e.g. 'Range') are sent along with the request.
 
     Returns the request object holding the file download response
     """
 
+    # Use a cached copy of the file if possible...partial downloads aren't cached
+    cache_meta = None
+    if headers is None:
+        cache_meta = _cacheLookup(api_url, {})
+        if cache_meta is not None and _cacheIsFresh(cache_meta):
+            cached = _cacheOpenFile(cache_meta)
+            if cached is not None:
+                _cacheUse(cache_meta, False)
+                return cached
+
+            # The cached copy disappeared after it was looked up, so treat it as a miss
+            cache_meta = None
+
+        headers = {}
+
     # Run the http request
     params = {'access_token': __getAccessToken()}
-    r = requests.get(api_url, params=params, stream=True)
+    r = _cacheFileRequest(api_url, params, headers, cache_meta)
 
-    if (r.status_code == 200):
+    if (r.status_code == 200 or r.status_code == 304):
         # Nothing went wrong, return the response
         return r
+    elif (r.status_code == 206):
+        return r
     else:
         data = json.loads(r.text)
 
@@ -433,7 +1574,7 @@ def _makeFileRequest(api_url):
             # Got an OAuth error, assume it's most likely to be an access token issue...
             if data['error_description'] == 'The access token provided has expired.':
                 # Attempt to get a new access token
-                result = __useRefreshToken()
+                result = __renewAccessToken(params['access_token'])
 
                 if 'access_token' not in result:
                     # Something happened while trying to get a new access_token, abort
@@ -442,10 +1583,12 @@ def _makeFileRequest(api_url):
                     params['access_token'] = result['access_token']
 
                 # Run the http request again with the new access token
-                r = requests.get(api_url, params=params, stream=True)
-                if (r.status_code == 200):
+                r = _cacheFileRequest(api_url, params, headers, cache_meta)
+                if (r.status_code == 200 or r.status_code == 304):
                     # Nothing went wrong, return the response
                     return r
+                elif (r.status_code == 206):
+                    return r
                 else:
                     data = json.loads(r.text)
 
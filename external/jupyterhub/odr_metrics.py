@@ -0,0 +1,191 @@
+# Open Data Repository Data Publisher
+# ODR JupyterHub service metrics
+# (C) 2015 by Nathan Stone (nate.stone@opendatarepository.org)
+# (C) 2015 by Alex Pires (ajpires@email.arizona.edu)
+# Released under the GPLv2
+
+"""
+Defines a minimal metrics registry shared by the ODR JupyterHub services, and Tornado handlers to record request
+metrics and to expose them in the Prometheus text format at a '/metrics' url.
+
+Intentionally doesn't depend on the prometheus_client package, so the services don't need anything extra installed.
+"""
+
+import math
+import threading
+
+from tornado.escape import json_encode, utf8
+from tornado.web import RequestHandler
+
+
+# Upper bounds (in seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metrics(object):
+    """
+    Holds counters, gauges and histograms, each identified by a name and an optional dict of labels.
+
+    Safe to update from multiple threads, since some of the services do work inside an executor.
+    """
+
+    def __init__(self, namespace, buckets=DEFAULT_BUCKETS):
+        self.namespace = namespace
+        self.buckets = tuple(buckets)
+
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+
+
+    def inc(self, name, amount=1, labels=None):
+        """
+        Adds amount to the counter identified by name and labels.
+        """
+
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+
+    def set(self, name, value, labels=None):
+        """
+        Sets the gauge identified by name and labels to value.
+        """
+
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._gauges[key] = value
+
+
+    def observe(self, name, value, labels=None):
+        """
+        Records value in the histogram identified by name and labels.
+        """
+
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+                self._histograms[key] = histogram
+
+            for i, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+
+    def get(self, name, labels=None):
+        """
+        Returns the current value of a counter or gauge, or 0 if it hasn't been recorded yet.
+        """
+
+        key = (name, _label_key(labels))
+        with self._lock:
+            if key in self._gauges:
+                return self._gauges[key]
+            return self._counters.get(key, 0)
+
+
+    def render(self):
+        """
+        Returns all the metrics as a string in the Prometheus text exposition format.
+        """
+
+        lines = []
+        with self._lock:
+            for kind, values in (('counter', self._counters), ('gauge', self._gauges)):
+                for name in sorted( set(key[0] for key in values) ):
+                    full_name = self.namespace + '_' + name
+                    lines.append('# TYPE ' + full_name + ' ' + kind)
+                    for key in sorted(k for k in values if k[0] == name):
+                        lines.append(full_name + _format_labels(key[1]) + ' ' + _format_value(values[key]))
+
+            for name in sorted( set(key[0] for key in self._histograms) ):
+                full_name = self.namespace + '_' + name
+                lines.append('# TYPE ' + full_name + ' histogram')
+                for key in sorted(k for k in self._histograms if k[0] == name):
+                    histogram = self._histograms[key]
+                    for upper_bound, count in zip(self.buckets, histogram['buckets']):
+                        bucket_labels = key[1] + (('le', _format_value(upper_bound)),)
+                        lines.append(full_name + '_bucket' + _format_labels(bucket_labels) + ' ' + str(count))
+                    lines.append(full_name + '_bucket' + _format_labels(key[1] + (('le', '+Inf'),)) + ' ' + str(histogram['count']))
+                    lines.append(full_name + '_sum' + _format_labels(key[1]) + ' ' + _format_value(histogram['sum']))
+                    lines.append(full_name + '_count' + _format_labels(key[1]) + ' ' + str(histogram['count']))
+
+        return '\n'.join(lines) + '\n'
+
+
+def _label_key(labels):
+    """
+    Returns a hashable, consistently ordered version of a dict of labels.
+    """
+
+    if not labels:
+        return ()
+    return tuple( sorted( (str(k), str(v)) for k, v in labels.items() ) )
+
+
+def _format_labels(label_key):
+    if not label_key:
+        return ''
+
+    escaped = []
+    for name, value in label_key:
+        value = value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(name + '="' + value + '"')
+    return '{' + ','.join(escaped) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+
+class MetricsRequestHandler(RequestHandler):
+    """
+    Base class for the handlers of a service, which records the number, latency and size of the requests they handle
+    in self.metrics once each request finishes.
+    """
+
+    metrics = None
+    _response_bytes = 0
+
+    def write(self, chunk):
+        # Dicts are encoded the same way RequestHandler.write() does, in order to count the bytes
+        if isinstance(chunk, dict):
+            self._response_bytes += len( utf8( json_encode(chunk) ) )
+        else:
+            self._response_bytes += len( utf8(chunk) )
+
+        super().write(chunk)
+
+
+    def on_finish(self):
+        if self.metrics is None:
+            return
+
+        handler_name = type(self).__name__
+        self.metrics.inc('http_requests_total', labels={'handler': handler_name, 'method': self.request.method, 'code': self.get_status()})
+        self.metrics.observe('http_request_duration_seconds', self.request.request_time(), labels={'handler': handler_name})
+        self.metrics.inc('http_request_bytes_total', len(self.request.body or b''), labels={'handler': handler_name})
+        self.metrics.inc('http_response_bytes_total', self._response_bytes, labels={'handler': handler_name})
+
+
+class MetricsHandler(RequestHandler):
+    """
+    Returns the service's metrics in the Prometheus text exposition format.
+    """
+
+    def initialize(self, metrics):
+        self.metrics = metrics
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write( self.metrics.render() )
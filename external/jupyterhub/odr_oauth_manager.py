@@ -16,18 +16,44 @@ TODO - ensure that this only listens to requests from localhost?
 
 import json
 import os
-import requests
+import tempfile
+import time
 
 from tornado.escape import json_decode
 from tornado.gen import coroutine
-#from tornado.httpclient import HTTPClient, HTTPRequest
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
 from tornado.httputil import url_concat
 from tornado.ioloop import IOLoop
 from tornado.log import app_log
-from tornado.web import Application, HTTPError, RequestHandler
+from tornado.web import Application, HTTPError
 
+from odr_metrics import Metrics, MetricsHandler, MetricsRequestHandler
+
+
+class TokenStore(object):
+    """
+    Keeps the OAuth tokens for all users in memory, indexed by the user_session_token that each notebook server uses
+    to identify itself, so looking up a user doesn't require reading and scanning the whole storage file.
+
+    Changes are written back to the storage file a short while after they happen, so a burst of changes only results
+    in a single write.  The file is replaced atomically, so a crash midway through a write can't corrupt it.
+    """
+
+    def __init__(self, filename, flush_delay=1.0, metrics=None):
+        self.filename = filename
+        self.flush_delay = flush_delay
+        self.metrics = metrics
+
+        self._tokens = self.load_tokens()
+        self._usernames = {}
+        for username, data in self._tokens.items():
+            self._usernames[ data['user_session_token'] ] = username
+
+        # Maps a user_session_token to the Future of a currently running refresh request for that user
+        self.pending_refreshes = {}
+
+        self._flush_handle = None
 
-class OAuthRequestHandler(RequestHandler):
 
     def load_tokens(self):
         """
@@ -38,10 +64,10 @@ class OAuthRequestHandler(RequestHandler):
         """
 
         # Don't want to create file if it doesn't already exist
-        if not os.path.isfile('oauth_token_storage.txt'):
+        if not os.path.isfile(self.filename):
             raise FileNotFoundError
 
-        with open('oauth_token_storage.txt', 'r') as handle:
+        with open(self.filename, 'r') as handle:
             data = json.load(handle)
             return data
 
@@ -50,16 +76,115 @@ class OAuthRequestHandler(RequestHandler):
         """
         Persists a dict of username:tokens for later retrieval.
 
-        Currently, they're stored in a simple text file in the same directory.
-        Ideally, this file should be readable/writable only by whichever user is running JupyterHub.
+        The dict is written to a temporary file in the same directory, which is then renamed over the original file.
+        tempfile.mkstemp() creates the temporary file so that it's only readable/writable by the current user.
         """
 
         # Don't want to create file if it doesn't already exist
-        if not os.path.isfile('oauth_token_storage.txt'):
+        if not os.path.isfile(self.filename):
             raise FileNotFoundError
 
-        with open('oauth_token_storage.txt', 'w') as handle:
-            json.dump(tokens_dict, handle)
+        directory = os.path.dirname( os.path.abspath(self.filename) )
+        fd, temp_filename = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as handle:
+                json.dump(tokens_dict, handle)
+                handle.flush()
+                os.fsync( handle.fileno() )
+
+            os.replace(temp_filename, self.filename)
+        except:
+            os.unlink(temp_filename)
+            raise
+
+
+    def get_user(self, user_session_token):
+        """
+        Returns a tuple of the username and the dict of tokens belonging to user_session_token, or (None, None) if
+        no user has that session token.
+        """
+
+        username = self._usernames.get(user_session_token)
+        if username is None:
+            return None, None
+
+        return username, self._tokens[username]
+
+
+    def set_user(self, username, user_tokens):
+        """
+        Replaces all the stored tokens for the given user.
+        """
+
+        # The user's previous notebook server is no longer allowed to use this user's tokens
+        if username in self._tokens:
+            self._usernames.pop( self._tokens[username]['user_session_token'], None )
+
+        self._tokens[username] = user_tokens
+        self._usernames[ user_tokens['user_session_token'] ] = username
+        self.schedule_flush()
+
+
+    def update_tokens(self, username, access_token, refresh_token, expires_in=None):
+        """
+        Replaces the access/refresh_token pair for the given user.
+        """
+
+        user_tokens = self._tokens[username]
+        user_tokens['access_token'] = access_token
+        user_tokens['refresh_token'] = refresh_token
+        user_tokens['expires_at'] = None
+        if expires_in is not None:
+            user_tokens['expires_at'] = time.time() + int(expires_in)
+
+        self.schedule_flush()
+
+
+    def schedule_flush(self):
+        """
+        Ensures the storage file gets rewritten after flush_delay seconds, unless a rewrite is already scheduled.
+        """
+
+        if self._flush_handle is None:
+            self._flush_handle = IOLoop.current().call_later(self.flush_delay, self.flush)
+
+
+    def flush(self):
+        """
+        Immediately writes the tokens for all users to the storage file.
+        """
+
+        if self._flush_handle is not None:
+            IOLoop.current().remove_timeout(self._flush_handle)
+            self._flush_handle = None
+
+        try:
+            self.store_tokens(self._tokens)
+        except Exception as e:
+            app_log.error('Unable to write OAuth tokens to "%s": %s', self.filename, e)
+            return
+
+        if self.metrics is not None:
+            self.metrics.inc('token_store_flushes_total')
+            self.metrics.set('token_store_users', len(self._tokens))
+
+
+def _expires_in(user_tokens):
+    """
+    Returns the number of seconds until the user's access token expires, or None if that isn't known.
+    """
+
+    if user_tokens.get('expires_at') is None:
+        return None
+
+    return max(0, int(user_tokens['expires_at'] - time.time()))
+
+
+class OAuthRequestHandler(MetricsRequestHandler):
+
+    def initialize(self, token_store, metrics):
+        self.token_store = token_store
+        self.metrics = metrics
 
 
 class CreateOAuthUser(OAuthRequestHandler):
@@ -99,13 +224,14 @@ class CreateOAuthUser(OAuthRequestHandler):
             raise HTTPError(403)
 
         # Store the provided parameters for later
-        __all_tokens = self.load_tokens()
-        __all_tokens[ self.username ] = {
+        self.token_store.set_user(self.username, {
             'access_token': self.access_token,
             'refresh_token': self.refresh_token,
             'user_session_token': self.user_session_token,
-        }
-        self.store_tokens(__all_tokens)
+            'expires_at': None,
+        })
+        if data.get('expires_in') is not None:
+            self.token_store.update_tokens(self.username, self.access_token, self.refresh_token, data['expires_in'])
 
 
 class GetAccessToken(OAuthRequestHandler):
@@ -115,18 +241,14 @@ class GetAccessToken(OAuthRequestHandler):
 
     def get(self, user_session_token):
         # Locate the user this session_token is referring to, if possible
-        __username = ''
-        __all_tokens = self.load_tokens()
-        for user, data in __all_tokens.items():
-            if data['user_session_token'] == user_session_token:
-                __username = user
+        __username, __user_tokens = self.token_store.get_user(user_session_token)
 
         # If user not found, return error
-        if __username == '':
+        if __username is None:
             raise HTTPError(404)
 
         # Otherwise, return the user's access token to the requesting application
-        self.write( {'access_token': __all_tokens[__username]['access_token']} )
+        self.write( {'access_token': __user_tokens['access_token'], 'expires_in': _expires_in(__user_tokens)} )
 
 
 class RequestNewAccessToken(OAuthRequestHandler):
@@ -136,66 +258,94 @@ class RequestNewAccessToken(OAuthRequestHandler):
     Returns a JSON response containing the new access/refresh_token pair if successful
     """
 
+    @coroutine
     def get(self, user_session_token):
         # Locate the user this session_token is referring to, if possible
-        __username = ''
-        __all_tokens = self.load_tokens()
-
-        for user, data in __all_tokens.items():
-            if data['user_session_token'] == user_session_token:
-                __username = user
+        __username, __user_tokens = self.token_store.get_user(user_session_token)
 
         # If user not found, return error
-        if __username == '':
+        if __username is None:
             raise HTTPError(404)
 
+        # If a refresh for this user is already waiting on the OAuth provider, then wait for that one instead of
+        #  using the same refresh token twice
+        future = self.token_store.pending_refreshes.get(user_session_token)
+        if future is not None:
+            self.metrics.inc('token_refreshes_coalesced_total')
+        else:
+            future = self.refresh_tokens(__username, __user_tokens['refresh_token'])
+            self.token_store.pending_refreshes[user_session_token] = future
+            future.add_done_callback(lambda f: self.token_store.pending_refreshes.pop(user_session_token, None))
+
+        result = yield future
+        self.write(result)
+
+
+    @coroutine
+    def refresh_tokens(self, username, refresh_token):
+        """
+        Requests a new access/refresh_token pair from the OAuth provider without blocking the IOLoop, and stores the
+        new pair if successful.
 
-        __user_tokens = __all_tokens[ __username ]
-        self.refresh_token = __user_tokens['refresh_token']
+        Returns a dict of the new access/refresh_token pair, or the error from the OAuth provider.
+        """
 
         # Request a new access/refresh_token pair from the OAuth provider
         params = dict(
             client_id=os.environ['oauth_client_id'],
             client_secret=os.environ['oauth_client_secret'],
             grant_type='refresh_token',
-            refresh_token=self.refresh_token
+            refresh_token=refresh_token
         )
         url = url_concat(os.environ['oauth_token_url'], params)
 
-        # Using the requests library instead of tornado because tornado seems to throw an uncatchable error if it receives a 400 response
         headers = {
             "Accept": "application/json",
             "User-Agent": "JupyterHub",
         }
-        r = requests.get(url, headers=headers)
-        resp_json = r.json()
+        req = HTTPRequest(url, method="GET", headers=headers, request_timeout=30)
+
+        # The provider responds with a 400 when the refresh token is invalid, so errors have to be returned instead
+        #  of raised in order to pass the provider's response back to the requesting application
+        resp = yield AsyncHTTPClient().fetch(req, raise_error=False)
+        self.metrics.observe('oauth_provider_request_duration_seconds', resp.request_time)
+        if resp.body is None:
+            self.metrics.inc('token_refreshes_total', labels={'result': 'error'})
+            return {'error': 'connection_error', 'error_description': str(resp.error)}
+
+        self.metrics.inc('oauth_provider_bytes_total', len(resp.body))
+        resp_json = json.loads(resp.body.decode('utf8', 'replace'))
 
         # Ensure the access_token exists
         if 'access_token' not in resp_json and 'refresh_token' not in resp_json:
-            self.write( resp_json )
-        else:
-            # Extract the new access/refresh_token pair from the OAuth provider
-            self.access_token = resp_json['access_token']
-            self.refresh_token = resp_json['refresh_token']
+            self.metrics.inc('token_refreshes_total', labels={'result': 'error'})
+            return resp_json
 
-            # Store the provided parameters for later
-            __user_tokens['access_token'] = self.access_token
-            __user_tokens['refresh_token'] = self.refresh_token
+        self.metrics.inc('token_refreshes_total', labels={'result': 'success'})
 
-            __all_tokens[ __username ] = __user_tokens
-            self.store_tokens(__all_tokens)
+        # Store the new access/refresh_token pair from the OAuth provider for later
+        self.token_store.update_tokens(username, resp_json['access_token'], resp_json['refresh_token'], resp_json.get('expires_in'))
 
-            # Return the new access/refresh_token pair to the requesting application
-            self.write( {'access_token': self.access_token, 'refresh_token': self.refresh_token} )
+        # Return the new access/refresh_token pair to the requesting application
+        return {
+            'access_token': resp_json['access_token'],
+            'refresh_token': resp_json['refresh_token'],
+            'expires_in': resp_json.get('expires_in'),
+        }
 
 
 def make_app():
+    metrics = Metrics('odr_oauth_manager')
+    token_store = TokenStore('oauth_token_storage.txt', metrics=metrics)
+    handler_args = dict(token_store=token_store, metrics=metrics)
+
     # All registered urls MUST be prefixed with os.environ['JUPYTERHUB_SERVICE_PREFIX']
     return Application([
-        ( os.environ['JUPYTERHUB_SERVICE_PREFIX'] + "/create_user", CreateOAuthUser),
-        ( os.environ['JUPYTERHUB_SERVICE_PREFIX'] + "/get_access_token/([a-f0-9]{64,64})", GetAccessToken),     # take a 64 character hex string identifying which user this is
-        ( os.environ['JUPYTERHUB_SERVICE_PREFIX'] + "/get_new_access_token/([a-f0-9]{64,64})", RequestNewAccessToken),
-    ])
+        ( os.environ['JUPYTERHUB_SERVICE_PREFIX'] + "/create_user", CreateOAuthUser, handler_args),
+        ( os.environ['JUPYTERHUB_SERVICE_PREFIX'] + "/get_access_token/([a-f0-9]{64,64})", GetAccessToken, handler_args),     # take a 64 character hex string identifying which user this is
+        ( os.environ['JUPYTERHUB_SERVICE_PREFIX'] + "/get_new_access_token/([a-f0-9]{64,64})", RequestNewAccessToken, handler_args),
+        ( os.environ['JUPYTERHUB_SERVICE_PREFIX'] + "/metrics", MetricsHandler, dict(metrics=metrics)),
+    ], token_store=token_store, metrics=metrics)
 
 if __name__ == '__main__':
     app = make_app()
@@ -206,3 +356,6 @@ if __name__ == '__main__':
         IOLoop.current().start()
     except KeyboardInterrupt:
         pass
+
+    # Don't lose any token changes that haven't been written to disk yet
+    app.settings['token_store'].flush()